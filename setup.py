@@ -20,6 +20,10 @@ setuptools.setup(
                 'tree_sitter_builds==2022.8.27',
                 'tree_sitter_languages==1.5.0',
     ],
+    extras_require={
+        'onnx': ['onnx', 'onnxruntime'],
+        'watch': ['watchdog'],
+    },
     long_description=long_description,
     long_description_content_type='text/markdown',
     python_requires='>=3.8',
@@ -0,0 +1,69 @@
+import numpy as np
+
+# Inverted file (IVF) index over the normalized corpus embeddings. Vectors are
+# partitioned into lists around k-means centroids; a query only scores the
+# vectors in the `n_probe` lists whose centroids are closest to it.
+
+
+def default_n_lists(n_vectors):
+    return max(1, int(4 * np.sqrt(n_vectors)))
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _assign(vectors, centroids, block_size=16384):
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        assignments[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def _kmeans(vectors, n_lists, n_iter, rng):
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+    for _ in range(n_iter):
+        assignments = _assign(vectors, centroids)
+        order = np.argsort(assignments, kind='stable')
+        lists, starts = np.unique(assignments[order], return_index=True)
+        # Lists that ended up empty keep their previous centroid
+        centroids[lists] = normalize(np.add.reduceat(vectors[order], starts, axis=0))
+    return centroids
+
+
+def build_ivf(embeddings, n_lists=None, n_iter=10, sample_per_list=64, seed=0):
+    rng = np.random.default_rng(seed)
+    n_lists = min(n_lists or default_n_lists(len(embeddings)), len(embeddings))
+    sample_size = min(len(embeddings), n_lists * sample_per_list)
+    sample = np.sort(rng.choice(len(embeddings), sample_size, replace=False))
+    centroids = _kmeans(np.asarray(embeddings[sample], dtype=np.float32), n_lists, n_iter, rng)
+
+    assignments = _assign(embeddings, centroids)
+    # Row ids are grouped by list and kept ascending within a list so that
+    # gathering a list's vectors reads the memory-mapped matrix front to back.
+    ids = np.argsort(assignments, kind='stable').astype(np.int64)
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignments, minlength=n_lists))
+    return {'centroids': centroids, 'offsets': offsets, 'ids': ids}
+
+
+def save_ivf(path, ivf):
+    for name, array in ivf.items():
+        np.save(path + '/ivf_' + name + '.npy', array)
+
+
+def load_ivf(path):
+    return {name: np.load(path + '/ivf_' + name + '.npy', mmap_mode='r')
+            for name in ['centroids', 'offsets', 'ids']}
+
+
+def ivf_candidates(ivf, query_embedding, n_probe):
+    centroid_scores = np.asarray(ivf['centroids']) @ query_embedding
+    n_probe = min(n_probe, len(centroid_scores))
+    probe = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+    offsets = ivf['offsets']
+    candidates = np.concatenate([ivf['ids'][offsets[i]:offsets[i + 1]] for i in probe])
+    return np.sort(candidates)
@@ -0,0 +1,72 @@
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class EncodeStats:
+    functions: int = 0
+    tokens: int = 0
+    padded_tokens: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+
+    def summary(self):
+        seconds = max(self.seconds, 1e-9)
+        padding = 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0
+        return 'Encoded {} functions ({} tokens) in {} batches in {:.1f}s: {:.1f} functions/s, {:.0f} tokens/s, {:.0%} padding'.format(
+            self.functions, self.tokens, self.batches, self.seconds, self.functions / seconds, self.tokens / seconds, padding)
+
+
+def token_lengths(model, texts):
+    max_length = getattr(model, 'max_seq_length', None) or 512
+    tokenizer = getattr(model, 'tokenizer', None)
+    if tokenizer is None:
+        # Rough estimate for models without a Hugging Face tokenizer
+        return np.minimum(np.array([len(t) // 4 + 2 for t in texts]), max_length)
+    encoded = tokenizer(texts, truncation=True, max_length=max_length, add_special_tokens=True)
+    return np.array([len(ids) for ids in encoded['input_ids']])
+
+
+def token_budget_batches(lengths, max_tokens, max_batch_size):
+    # Texts are sorted by length so that each batch holds texts of similar
+    # length, then batches are cut when padding every member to the longest one
+    # would exceed the token budget.
+    batches = []
+    batch = []
+    for i in np.argsort(-lengths, kind='stable'):
+        if batch and ((len(batch) + 1) * lengths[batch[0]] > max_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def encode_batched(model, texts, batch_size, max_batch_tokens, stats):
+    start = time.perf_counter()
+    if max_batch_tokens:
+        lengths = token_lengths(model, texts)
+        batches = token_budget_batches(lengths, max_batch_tokens, batch_size)
+    else:
+        lengths = None
+        batches = [list(range(i, min(i + batch_size, len(texts)))) for i in range(0, len(texts), batch_size)]
+
+    vectors = None
+    for batch in batches:
+        encoded = model.encode([texts[i] for i in batch], batch_size=len(batch),
+                               convert_to_numpy=True, show_progress_bar=False)
+        if vectors is None:
+            vectors = np.zeros((len(texts), encoded.shape[1]), dtype=np.float32)
+        # Restore the original order
+        vectors[batch] = encoded
+
+    stats.functions += len(texts)
+    stats.batches += len(batches)
+    if lengths is not None:
+        stats.tokens += int(lengths.sum())
+        stats.padded_tokens += int(sum(len(b) * lengths[b[0]] for b in batches))
+    stats.seconds += time.perf_counter() - start
+    return vectors
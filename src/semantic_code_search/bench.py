@@ -0,0 +1,200 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import zlib
+from subprocess import run
+
+import numpy as np
+
+from semantic_code_search.batching import EncodeStats, encode_batched
+from semantic_code_search.cluster import _get_clusters
+from semantic_code_search.embed import _get_repo_files, _get_repo_functions
+from semantic_code_search.encoders import encoder_name
+from semantic_code_search.index import IndexWriter, load_index
+from semantic_code_search.languages import get_languages
+from semantic_code_search.profiling import peak_rss_mb
+from semantic_code_search.quantize import METHODS, bytes_per_vector, load_quantized, quantize
+from semantic_code_search.query import _search
+
+# Templates of a single function per language, with the file header they need
+_templates = {
+    '.py': ('', '#', 'def {name}(a, b):\n{body}    return a + b\n\n'),
+    '.js': ('', '//', 'function {name}(a, b) {{\n{body}  return a + b;\n}}\n\n'),
+    '.ts': ('', '//', 'function {name}(a: number, b: number): number {{\n{body}  return a + b;\n}}\n\n'),
+    '.go': ('package main\n\n', '//', 'func {name}(a int, b int) int {{\n{body}\treturn a + b\n}}\n\n'),
+    '.rs': ('', '//', 'fn {name}(a: i32, b: i32) -> i32 {{\n{body}    a + b\n}}\n\n'),
+    '.rb': ('', '#', 'def {name}(a, b)\n{body}  a + b\nend\n\n'),
+    '.java': ('class Bench {\n', '//', '  int {name}(int a, int b) {{\n{body}    return a + b;\n  }}\n\n'),
+    '.c': ('', '//', 'int {name}(int a, int b) {{\n{body}    return a + b;\n}}\n\n'),
+    '.cpp': ('', '//', 'int {name}(int a, int b) {{\n{body}    return a + b;\n}}\n\n'),
+    '.kt': ('', '//', 'fun {name}(a: Int, b: Int): Int {{\n{body}    return a + b\n}}\n\n'),
+    '.php': ('<?php\n', '//', 'function {name}($a, $b) {{\n{body}    return $a + $b;\n}}\n\n'),
+}
+
+# Modules that must not be imported by `sem --help`
+_heavy_modules = ['numpy', 'torch', 'sentence_transformers', 'transformers', 'sklearn', 'tree_sitter',
+                  'tree_sitter_languages', 'prompt_toolkit', 'pygments']
+
+_words = ['user', 'request', 'parse', 'queue', 'cache', 'token', 'write', 'read', 'file', 'retry', 'error',
+          'config', 'database', 'socket', 'event', 'handler', 'index', 'search', 'vector', 'batch', 'session']
+
+
+# Deterministic stand-in for a SentenceTransformer that hashes words into a
+# fixed number of dimensions. It is fast enough that the other stages dominate.
+class HashingEncoder():
+    max_seq_length = 512
+    tokenizer = None
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, show_progress_bar=False, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else sentences
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.split():
+                vectors[i, zlib.crc32(word.encode('utf8')) % self.dim] += 1
+        return vectors[0] if single else vectors
+
+
+def generate_repo(path, n_files, functions_per_file, seed=0):
+    rng = np.random.default_rng(seed)
+    extensions = list(_templates)
+    for i in range(n_files):
+        ext = extensions[i % len(extensions)]
+        header, comment, template = _templates[ext]
+        content = [header]
+        for j in range(functions_per_file):
+            # Function bodies of very different lengths, as in real code
+            n_lines = int(rng.integers(0, 40))
+            body = ''.join('    {} {}\n'.format(comment, ' '.join(rng.choice(_words, 8))) for _ in range(n_lines))
+            content.append(template.format(name='f_{}_{}'.format(i, j), body=body))
+        if ext == '.java':
+            content.append('}\n')
+        os.makedirs('{}/pkg{}'.format(path, i % 100), exist_ok=True)
+        with open('{}/pkg{}/file{}{}'.format(path, i % 100, i, ext), 'w') as f:
+            f.write(''.join(content))
+    run(['git', 'init', '-q', path], check=True)
+    run(['git', '-C', path, 'add', '.'], check=True)
+
+
+def _latencies(search, queries):
+    latencies = []
+    for q in queries:
+        start = time.perf_counter()
+        search(q)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3)}
+
+
+def _startup(repeat=3):
+    # Wall time of a fresh `sem --help` process (best of a few runs) and the
+    # heavy modules it imports
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_parent, os.environ.get('PYTHONPATH')])))
+    command = [sys.executable, '-X', 'importtime', '-m', 'semantic_code_search.cli', '--help']
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        p = run(command, env=env, capture_output=True, check=True)
+        seconds.append(time.perf_counter() - start)
+    imported = {line.rsplit('|', 1)[-1].strip().split('.')[0]
+                for line in p.stderr.decode('utf8').splitlines() if line.startswith('import time:')}
+    return {'seconds': round(min(seconds), 4), 'heavy_imports': sorted(imported.intersection(_heavy_modules))}
+
+
+def _recall(results, expected):
+    recalls = [len({(f['file'], f['line']) for _, f in r} & {(f['file'], f['line']) for _, f in e}) / max(len(e), 1)
+               for r, e in zip(results, expected)]
+    return round(float(np.mean(recalls)), 4) if recalls else None
+
+
+def _quantization_tradeoff(root, index, query_vectors, k, rescore):
+    # Recall@k of every quantization against exact search, with the first pass
+    # alone (the k best quantized rows) and with the shortlist rescored
+    dim = index.meta.get('dim')
+    report = {index.meta.get('dtype'): {'bytes_per_vector': dim * np.dtype(index.meta.get('dtype')).itemsize,
+                                        'recall_at_k': 1.0}}
+    expected = [_search(q, index, k=k) for q in query_vectors]
+    for method in METHODS:
+        path = '{}/quantized-{}'.format(root, method)
+        os.makedirs(path)
+        quantize(index.embeddings, method, path)
+        index.quantized = load_quantized(path, method)
+        report[method] = {'bytes_per_vector': bytes_per_vector(method, dim),
+                          'recall_at_k_first_pass': _recall([_search(q, index, k=k, rescore=1) for q in query_vectors], expected),
+                          'recall_at_k': _recall([_search(q, index, k=k, rescore=rescore) for q in query_vectors], expected)}
+        report[method].update(_latencies(lambda q: _search(q, index, k=k, rescore=rescore), query_vectors))
+    index.quantized = None
+    return report
+
+
+def do_bench(args, model=None):
+    report = {'files': args.bench_files, 'functions_per_file': args.bench_functions_per_file,
+              'model': encoder_name(args) if model is not None else 'HashingEncoder', 'stages': {}}
+    model = model or HashingEncoder()
+
+    def stage(name, func):
+        start = time.perf_counter()
+        result = func()
+        report['stages'][name] = {'seconds': round(time.perf_counter() - start, 4), 'peak_rss_mb': peak_rss_mb()}
+        return result
+
+    startup = report['stages']['startup'] = _startup()
+
+    with tempfile.TemporaryDirectory(prefix='sem-bench-') as root:
+        stage('generate', lambda: generate_repo(root, args.bench_files, args.bench_functions_per_file))
+        files = stage('list_files', lambda: _get_repo_files(root))
+        functions = stage('extract', lambda: _get_repo_functions(
+            root, get_languages(args.languages), list(files), args.jobs))
+        report['functions'] = len(functions)
+
+        stats = EncodeStats()
+        vectors = stage('encode', lambda: encode_batched(
+            model, [f['text'] for f in functions], args.batch_size, args.max_batch_tokens, stats))
+        report['stages']['encode'].update({'functions_per_second': round(stats.functions / max(stats.seconds, 1e-9), 1),
+                                           'tokens_per_second': round(stats.tokens / max(stats.seconds, 1e-9), 1)})
+
+        def write():
+            writer = IndexWriter(root, 'bench', dtype=args.dtype, ann_lists=args.ann_lists if args.ann else None,
+                                 ann_min_size=args.ann_min_size)
+            writer.add(functions, vectors)
+            return writer.commit(files)
+        stage('write_index', write)
+        del functions, vectors
+
+        def load():
+            index = load_index(root)
+            # Touch the lazily loaded parts so that their cost is measured
+            index.embeddings[0], index.column('file')[0], index.paths, index.ivf
+            return index
+        index = stage('load_index', load)
+
+        rng = np.random.default_rng(1)
+        queries = [' '.join(rng.choice(_words, 4)) for _ in range(args.bench_queries)]
+        query_vectors = stage('encode_queries', lambda: [model.encode(q) for q in queries])
+        report['stages']['search'] = _latencies(lambda q: _search(q, index, k=args.n_results), query_vectors)
+        if index.ivf is not None:
+            report['stages']['search_ann'] = _latencies(
+                lambda q: _search(q, index, k=args.n_results, n_probe=args.ann_probe), query_vectors)
+        report['quantization'] = _quantization_tradeoff(root, index, query_vectors, args.n_results, args.rescore)
+
+        clusters = stage('cluster', lambda: _get_clusters(index, args.cluster_max_distance, args.cluster_method,
+                                                          args.cluster_neighbors, args.ann_probe))
+        report['clusters'] = len(clusters)
+
+    output = json.dumps(report, indent=2)
+    if args.bench_output:
+        with open(args.bench_output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    if startup['heavy_imports'] or (args.bench_startup_budget and startup['seconds'] > args.bench_startup_budget):
+        print('sem --help took {}s and imported {}, the budget is {}s without heavy imports'.format(
+            startup['seconds'], ', '.join(startup['heavy_imports']) or 'nothing heavy', args.bench_startup_budget),
+            file=sys.stderr)
+        sys.exit(1)
+    return report
@@ -0,0 +1,68 @@
+import hashlib
+
+from semantic_code_search.batching import token_lengths
+
+
+# Units longer than the model's maximum sequence length would be truncated by
+# the model, so only their beginning would be represented. They are split into
+# overlapping windows of whole lines instead, every window becoming a row of its
+# own. The rows of a unit follow each other in the index, share the unit's text
+# and are numbered by their `chunk`, so that queries can max-pool the scores of
+# the windows back onto the unit.
+
+
+def _line_lengths(model, lines):
+    tokenizer = getattr(model, 'tokenizer', None)
+    if tokenizer is None:
+        return [len(line) // 4 + 1 for line in lines]
+    encoded = tokenizer(lines, add_special_tokens=False)
+    # Line breaks are usually not tokens of their own
+    return [max(1, len(ids)) for ids in encoded['input_ids']]
+
+
+def windows(lengths, size, overlap):
+    # Splits lines with the given token lengths into [start, end) ranges of at
+    # most `size` tokens, where each range repeats about `overlap` tokens of the
+    # previous one. A line longer than `size` is a window of its own.
+    ranges = []
+    start = 0
+    while start < len(lengths):
+        end = start
+        tokens = 0
+        while end < len(lengths) and (end == start or tokens + lengths[end] <= size):
+            tokens += lengths[end]
+            end += 1
+        ranges.append((start, end))
+        if end == len(lengths):
+            break
+        next_start = end
+        tokens = 0
+        while next_start - 1 > start and tokens + lengths[next_start - 1] <= overlap:
+            next_start -= 1
+            tokens += lengths[next_start]
+        start = next_start
+    return ranges
+
+
+def chunk_units(model, units, size, overlap):
+    # Returns the rows for `units`. Units read back from a previous index are
+    # already chunked and are passed through.
+    new = [i for i, u in enumerate(units) if 'chunk' not in u]
+    long_units = set()
+    if new and size != 0:
+        # Windows default to, and are at most, the model's maximum sequence length
+        max_length = getattr(model, 'max_seq_length', None) or 512
+        size = min(size or max_length, max_length)
+        lengths = token_lengths(model, [units[i]['text'] for i in new])
+        long_units = {i for i, length in zip(new, lengths) if length >= size}
+    rows = []
+    for i, unit in enumerate(units):
+        if i not in long_units:
+            rows.append(unit)
+            continue
+        lines = unit['text'].split('\n')
+        # Two tokens are left for the special tokens the model adds
+        for chunk, (start, end) in enumerate(windows(_line_lengths(model, lines), size - 2, overlap)):
+            text = '\n'.join(lines[start:end])
+            rows.append(dict(unit, chunk=chunk, chunk_text=text, hash=hashlib.sha1(text.encode('utf8')).hexdigest()))
+    return rows
@@ -3,11 +3,9 @@ import os
 import sys
 from subprocess import run
 
-from sentence_transformers import SentenceTransformer
-
-from semantic_code_search.embed import do_embed
-from semantic_code_search.query import do_query
-from semantic_code_search.cluster import do_cluster
+# Modes import what they need when they run, so that `sem --help` and queries
+# answered by a server or from the query cache do not pay for importing torch,
+# sentence_transformers, tree-sitter or sklearn.
 
 
 def git_root(path=None):
@@ -24,64 +22,232 @@ def git_root(path=None):
     return p.stdout.decode('utf-8').strip()
 
 
+# Loads the encoder on first use, so that queries answered from the query cache
+# and clustering of an existing index never pay for it
+class LazyModel():
+
+    def __init__(self, args):
+        self.args = args
+        self._model = None
+
+    def __getattr__(self, name):
+        if self._model is None:
+            from semantic_code_search import profiling
+            from semantic_code_search.encoders import load_encoder
+            with profiling.stage('load model'):
+                self._model = load_encoder(self.args)
+        return getattr(self._model, name)
+
+
 def embed_func(args):
-    model = SentenceTransformer(args.model_name_or_path)
-    do_embed(args, model)
+    if args.workspace:
+        from semantic_code_search.workspace import do_workspace_embed
+        do_workspace_embed(args, LazyModel(args))
+        return
+    from semantic_code_search.embed import do_embed
+    do_embed(args, LazyModel(args))
+
+
+def workspace_func(args):
+    from semantic_code_search.workspace import update_workspace
+    repos = update_workspace(args.workspace, [git_root(path) for path in args.add_repo or []],
+                             [os.path.realpath(path) for path in args.remove_repo or []])
+    print('Workspace {} has {} repos:'.format(args.workspace, len(repos)))
+    for root in repos:
+        print('  ' + root)
 
 
 def query_func(args):
-    model = SentenceTransformer(args.model_name_or_path)
     if len(args.query_text) > 0:
         args.query_text = ' '.join(args.query_text)
     else:
         args.query_text = None
-    do_query(args, model)
+    # Use a running `sem --serve` for this repo if there is one, which avoids
+    # loading the model and the index
+    from semantic_code_search.server import query_server
+    results = None
+    if args.query_text and not args.no_server and not args.workspace:
+        results = query_server(args)
+    model = LazyModel(args) if results is None else None
+    from semantic_code_search.query import do_query
+    do_query(args, model, results)
+
+
+def batch_query_func(args):
+    from semantic_code_search.query import do_batch_query
+    do_batch_query(args, LazyModel(args))
+
+
+def bench_func(args):
+    from semantic_code_search.bench import do_bench
+    do_bench(args, LazyModel(args) if args.bench_with_model else None)
+
+
+def watch_func(args):
+    from semantic_code_search.watch import do_watch
+    do_watch(args, LazyModel(args))
+
+
+def serve_func(args):
+    from semantic_code_search.server import do_serve
+    do_serve(args, LazyModel(args))
 
 
 def cluster_func(args):
-    model = SentenceTransformer(args.model_name_or_path)
-    do_cluster(args, model)
+    from semantic_code_search.cluster import do_cluster
+    do_cluster(args, LazyModel(args))
 
 
 def main():
     parser = argparse.ArgumentParser(
         prog='sem', description='Search your codebase using natural language')
-    parser.add_argument('-p', '--path-to-repo', metavar='PATH', default=git_root(), type=git_root, required=False,
+    parser.add_argument('-p', '--path-to-repo', metavar='PATH', type=git_root, required=False,
                         help='Path to the root of the git repo to search or embed')
     parser.add_argument('-m', '--model-name-or-path', metavar='MODEL', default='krlvi/sentence-msmarco-bert-base-dot-v5-nlpl-code_search_net',
                         type=str, required=False, help='Name or path of the model to use')
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch', required=False,
+                        help='How the model is run. onnx exports the model to ONNX once and runs it with ONNX Runtime, which is faster on CPUs (needs `pip install semantic-code-search[onnx]`)')
+    parser.add_argument('--onnx-quantize', action='store_true', default=False, required=False,
+                        help='With --backend onnx, use a dynamically int8 quantized copy of the model, which is faster still at a small loss of accuracy')
+    parser.add_argument('--threads', metavar='N', type=int, default=0, required=False,
+                        help='Number of threads used to run the model (default: chosen by the backend)')
+    parser.add_argument('--parity-tolerance', metavar='TOL', type=float, required=False,
+                        help='Largest difference of cosine scores between the ONNX export and the PyTorch model that is accepted (default: 1e-3, 5e-2 with --onnx-quantize)')
+    parser.add_argument('-w', '--workspace', metavar='FILE', type=str, required=False,
+                        help='Workspace file listing several repos. Embedding, queries and batch queries then cover all of them, with results tagged by repo')
+    parser.add_argument('--add-repo', metavar='PATH', action='append', required=False,
+                        help='Add the git repo at PATH to the --workspace file (can be repeated)')
+    parser.add_argument('--remove-repo', metavar='PATH', action='append', required=False,
+                        help='Remove the repo at PATH from the --workspace file (can be repeated)')
     parser.add_argument('-d', '--embed', action='store_true', default=False,
                         required=False, help='(Re)create the embeddings index for codebase')
+    parser.add_argument('--incremental', action='store_true', default=False, required=False,
+                        help='When (re)creating the embeddings index, only re-parse files that changed since the last run and only re-encode functions whose text changed')
     parser.add_argument('-b', '--batch-size', metavar='BS',
-                              type=int, default=32, help='Batch size for embeddings generation')
+                              type=int, default=32, help='Maximum batch size for embeddings generation')
+    parser.add_argument('--max-batch-tokens', metavar='N', type=int, default=8192, required=False,
+                        help='Token budget per batch for embeddings generation. Functions are grouped by length and each batch is limited to N tokens including padding. 0 uses fixed size batches of --batch-size')
+    parser.add_argument('--shard-size', metavar='N', type=int, default=4096, required=False,
+                        help='Number of functions encoded and written to disk at a time when creating the embeddings index. Bounds memory use; an interrupted run resumes from the last completed shard')
+    parser.add_argument('--chunk-size', metavar='N', type=int, required=False,
+                        help='Functions longer than N tokens are split into overlapping windows that are embedded separately (default: the maximum sequence length of the model). 0 embeds every function whole, truncated by the model')
+    parser.add_argument('--chunk-overlap', metavar='N', type=int, default=64, required=False,
+                        help='Number of tokens consecutive windows of a long function have in common')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=os.cpu_count() or 1, required=False,
+                        help='Number of processes used to extract functions from source files (default: number of CPUs)')
+    parser.add_argument('--languages', metavar='FILE', type=str, required=False,
+                        help='JSON file with additional tree-sitter query patterns or languages to extract, in the same shape as the built-in table in languages.py')
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default='float32', required=False,
+                        help='Precision of the vectors stored in the embeddings index. float16 halves the index size')
+    parser.add_argument('--ann', action='store_true', default=False, required=False,
+                        help='When (re)creating the embeddings index, also build an approximate nearest neighbor (IVF) index that is used to speed up queries on large codebases')
+    parser.add_argument('--ann-lists', metavar='N', type=int, default=0, required=False,
+                        help='Number of partitions of the approximate nearest neighbor index (default: 4 * sqrt(number of functions))')
+    parser.add_argument('--ann-min-size', metavar='N', type=int, default=20000, required=False,
+                        help='Only build the approximate nearest neighbor index for codebases with at least this many functions, smaller ones are searched exhaustively')
+    parser.add_argument('--ann-probe', metavar='N', type=int, default=16, required=False,
+                        help='Number of partitions scanned per query. Higher values improve recall at the cost of latency')
+    parser.add_argument('--quantize', choices=['int8', 'binary'], required=False,
+                        help='When (re)creating the embeddings index, also store int8 (1 byte per dimension) or binary (1 bit per dimension) copies of the vectors. Queries scan these first and rescore the best candidates with the full vectors')
+    parser.add_argument('--rescore', metavar='N', type=int, default=10, required=False,
+                        help='Number of candidates per requested result that are taken from the quantized vectors and rescored. Higher values improve recall at the cost of latency')
+    parser.add_argument('--exact', action='store_true', default=False, required=False,
+                        help='Ignore the approximate nearest neighbor index and quantized vectors and score every function')
 
     parser.add_argument('-x', '--file-extension', metavar='EXT', type=str, required=False,
                               help='File extension filter (e.g. "py" will only return results from Python files)')
+    parser.add_argument('-l', '--language', metavar='LANG', type=str, required=False,
+                        help='Language filter (e.g. "python", "typescript")')
+    parser.add_argument('-g', '--path-glob', metavar='GLOB', type=str, required=False,
+                        help='Path filter, a glob relative to the repo root (e.g. "src/api/*" or "*_test.go")')
     parser.add_argument('-n', '--n-results', metavar='N', type=int,
                         required=False, default=5, help='Number of results to return')
+    parser.add_argument('--batch', metavar='FILE', type=str, required=False,
+                        help='Run every query in FILE (one per line, - for stdin) and print the results to stdout instead of opening the interactive prompt')
+    parser.add_argument('--format', choices=['jsonl', 'json'], default='jsonl', required=False,
+                        help='Output format of --batch: one JSON object per query and line, or a single JSON array')
+    parser.add_argument('--query-cache-size', metavar='MB', type=float, default=16, required=False,
+                        help='Size limit of the on-disk cache of query embeddings shared by all repos, least recently used queries are evicted first. 0 disables the cache')
     parser.add_argument('-e', '--editor', choices=[
                         'vscode', 'vim'], default='vscode', required=False, help='Editor to open selected result in')
     parser.add_argument('-c', '--cluster', action='store_true', default=False,
                         required=False, help='Generate clusters of code that is semantically similar. You can use this to spot near duplicates, results are simply printed to stdout')
     parser.add_argument('--cluster-max-distance', metavar='THRESHOLD', type=float, default=0.2, required=False,
                         help='How close functions need to be to one another to be clustered. Distance 0 means that the code is identical, smaller values (e.g. 0.2, 0.3) are stricter and result in fewer matches ')
+    parser.add_argument('--cluster-method', choices=['auto', 'agglomerative', 'graph'], default='auto', required=False,
+                        help='agglomerative clustering is exact but needs memory quadratic in the number of functions. graph links every function to its nearest neighbors within the distance threshold and scales to large codebases. auto picks agglomerative for small codebases')
+    parser.add_argument('--cluster-neighbors', metavar='K', type=int, default=10, required=False,
+                        help='Number of nearest neighbors considered per function by the graph clustering')
     parser.add_argument('--cluster-min-lines', metavar='SIZE', type=int, default=0, required=False,
                         help='Ignore clusters with code snippets smaller than this size (lines of code). Use this if you are not interested in smaller duplications (eg. one liners)')
     parser.add_argument('--cluster-min-cluster-size', metavar='SIZE', type=int, default=2, required=False,
                         help='Ignore clusters smaller than this size. Use this if you want to find code that is similar and repeated many times (e.g. >5)')
     parser.add_argument('--cluster-ignore-identincal', action='store_true', default=True,
                         required=False, help='Ignore identical code / exact duplicates (where distance is 0)')
+    parser.add_argument('--watch', action='store_true', default=False, required=False,
+                        help='Keep the embeddings index up to date with the working tree, including untracked files. Runs until interrupted')
+    parser.add_argument('--watch-debounce', metavar='SECONDS', type=float, default=2.0, required=False,
+                        help='Wait until no file changed for this long before updating the index')
+    parser.add_argument('--watch-interval', metavar='SECONDS', type=float, default=5.0, required=False,
+                        help='How often to check for changes when watchdog is not installed (`pip install semantic-code-search[watch]`)')
+    parser.add_argument('--serve', action='store_true', default=False, required=False,
+                        help='Keep the model and the embeddings index loaded and answer queries for this repo from a local socket. Subsequent queries use the server automatically')
+    parser.add_argument('--no-server', action='store_true', default=False, required=False,
+                        help='Do not use a running server, load the model and the index in this process')
+    parser.add_argument('--bench', action='store_true', default=False, required=False,
+                        help='Benchmark extraction, encoding, index writing and loading, search and clustering on a generated repo and print the results as JSON')
+    parser.add_argument('--bench-files', metavar='N', type=int, default=1000, required=False,
+                        help='Number of source files in the generated benchmark repo')
+    parser.add_argument('--bench-functions-per-file', metavar='N', type=int, default=10, required=False,
+                        help='Number of functions per file in the generated benchmark repo')
+    parser.add_argument('--bench-queries', metavar='N', type=int, default=100, required=False,
+                        help='Number of queries used to measure search latency')
+    parser.add_argument('--bench-with-model', action='store_true', default=False, required=False,
+                        help='Benchmark with the model given by --model-name-or-path instead of a fast stub encoder')
+    parser.add_argument('--bench-startup-budget', metavar='SECONDS', type=float, default=1.0, required=False,
+                        help='Fail the benchmark if `sem --help` takes longer than this or imports any heavy module. 0 only checks the imports')
+    parser.add_argument('--bench-output', metavar='FILE', type=str, required=False,
+                        help='Also write the benchmark results to this file')
+    parser.add_argument('--profile', action='store_true', default=False, required=False,
+                        help='Print the time, counts and peak memory of every stage (listing files, parsing, encoding, writing, searching, clustering, ...) to stderr when done')
+    parser.add_argument('--profile-trace', metavar='FILE', type=str, required=False,
+                        help='Also write the stages to FILE in the Chrome trace event format, viewable in chrome://tracing or Perfetto. Implies --profile')
     parser.set_defaults(func=query_func)
     parser.add_argument('query_text', nargs=argparse.REMAINDER)
 
     args = parser.parse_args()
-
-    if args.embed:
-        embed_func(args)
-    elif args.cluster:
-        cluster_func(args)
-    else:
-        query_func(args)
+    if (args.add_repo or args.remove_repo) and not args.workspace:
+        parser.error('--add-repo and --remove-repo need --workspace')
+    if args.workspace and (args.cluster or args.serve or args.watch):
+        parser.error('--cluster, --serve and --watch work on a single repo, not a --workspace')
+    if args.path_to_repo is None and not args.bench and not args.workspace:
+        # Resolved after parsing so that --help and argument errors do not shell out
+        args.path_to_repo = git_root()
+
+    if args.profile or args.profile_trace:
+        from semantic_code_search import profiling
+        profiling.enable()
+    try:
+        if args.add_repo or args.remove_repo:
+            workspace_func(args)
+        elif args.embed:
+            embed_func(args)
+        elif args.cluster:
+            cluster_func(args)
+        elif args.watch:
+            watch_func(args)
+        elif args.serve:
+            serve_func(args)
+        elif args.bench:
+            bench_func(args)
+        elif args.batch:
+            batch_query_func(args)
+        else:
+            query_func(args)
+    finally:
+        # Also when a mode exits through sys.exit, as queries do
+        if args.profile or args.profile_trace:
+            profiling.report(args.profile_trace)
 
 
 if __name__ == '__main__':
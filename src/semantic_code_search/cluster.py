@@ -1,84 +1,160 @@
-import gzip
-import os
-import pickle
+from semantic_code_search import profiling
+from semantic_code_search.ann import build_ivf
 from semantic_code_search.embed import do_embed
-from sklearn.cluster import AgglomerativeClustering
+from semantic_code_search.index import load_index
 import numpy as np
 from textwrap import indent
 
+# Below this many functions the exact agglomerative clustering is used by default
+_agglomerative_max_size = 20000
 
-def _get_clusters(dataset, distance_threshold):
-    embeddings = dataset.get('embeddings')
-    # Normalize the embeddings to unit length
-    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
-    dataset['embeddings'] = embeddings
+
+def _agglomerative_labels(embeddings, distance_threshold):
+    from sklearn.cluster import AgglomerativeClustering
 
     clustering_model = AgglomerativeClustering(
         n_clusters=None,
         distance_threshold=distance_threshold,
-        compute_distances=True,
     )
-    clustering_model.fit(embeddings)
-    cluster_assignment = clustering_model.labels_
-    cluster_distances = clustering_model.distances_
-    cluster_children = clustering_model.children_
+    clustering_model.fit(np.asarray(embeddings, dtype=np.float32))
+    return clustering_model.labels_
 
-    clustered_functions = {}
-    for idx, cluster_id in enumerate(cluster_assignment):
-        if cluster_id not in clustered_functions:
-            clustered_functions[cluster_id] = []
 
-        ds_entry = dataset.get('functions')[idx]
-        ds_entry['idx'] = idx
+def _keep_neighbors(rows, candidates, similarities, min_similarity, max_neighbors):
+    # Keeps the `max_neighbors` most similar candidates of every row that are
+    # within the threshold, and returns them as (row, candidate) edges
+    if similarities.shape[1] > max_neighbors:
+        top = np.argpartition(-similarities, max_neighbors - 1, axis=1)[:, :max_neighbors]
+        similarities = np.take_along_axis(similarities, top, axis=1)
+        neighbors = candidates[top]
+    else:
+        neighbors = np.broadcast_to(candidates, similarities.shape)
+    keep = (similarities >= min_similarity) & (neighbors != rows[:, None])
+    return np.broadcast_to(rows[:, None], keep.shape)[keep], neighbors[keep]
 
-        clustered_functions[cluster_id].append(ds_entry)
 
-    # filter out clusters with only one function
-    clusters = []
-    for cluster_id, functions in clustered_functions.items():
-        if len(functions) > 1:
-            fx_idx = functions[0].get('idx')
-            distances = []
-            for f in functions[1:]:
-                f_idx = f.get('idx')
-                for i, cc in enumerate(cluster_children):
-                    if cc.tolist() == [fx_idx, f_idx]:
-                        distances.append(cluster_distances[i])
-            avg_distance = sum(distances) / \
-                len(distances) if len(distances) > 0 else 0
-            clusters.append(
-                {'avg_distance': avg_distance, 'functions': functions})
+def _neighbor_edges(embeddings, ivf, min_similarity, max_neighbors, n_probe, block_size=1024):
+    # Yields the edges of the thresholded k-NN graph. With an IVF index only the
+    # vectors of the `n_probe` partitions closest to a partition are compared,
+    # otherwise the corpus is compared exhaustively one block at a time. Neither
+    # ever holds a dense N x N distance matrix.
+    if ivf is None:
+        candidates = np.arange(len(embeddings))
+        for start in range(0, len(embeddings), block_size):
+            block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+            similarities = np.concatenate([block @ np.asarray(embeddings[s:s + 65536], dtype=np.float32).T
+                                           for s in range(0, len(embeddings), 65536)], axis=1)
+            yield _keep_neighbors(candidates[start:start + block_size], candidates, similarities,
+                                  min_similarity, max_neighbors)
+        return
+
+    centroids = np.asarray(ivf['centroids'])
+    offsets = ivf['offsets']
+    n_probe = min(n_probe, len(centroids))
+    for list_id in range(len(centroids)):
+        rows = np.asarray(ivf['ids'][offsets[list_id]:offsets[list_id + 1]])
+        if len(rows) == 0:
+            continue
+        probe = np.argpartition(-(centroids @ centroids[list_id]), n_probe - 1)[:n_probe]
+        candidates = np.sort(np.concatenate([ivf['ids'][offsets[i]:offsets[i + 1]] for i in probe]))
+        similarities = np.asarray(embeddings[rows], dtype=np.float32) @ np.asarray(
+            embeddings[candidates], dtype=np.float32).T
+        yield _keep_neighbors(rows, candidates, similarities, min_similarity, max_neighbors)
+
+
+def _connected_components(n, edges):
+    # Min-label propagation with pointer jumping, vectorized over all edges
+    labels = np.arange(n)
+    sources = np.concatenate([e[0] for e in edges] + [np.array([], dtype=np.int64)]).astype(np.int64)
+    targets = np.concatenate([e[1] for e in edges] + [np.array([], dtype=np.int64)]).astype(np.int64)
+    while True:
+        low = np.minimum(labels[sources], labels[targets])
+        hooked = labels.copy()
+        np.minimum.at(hooked, labels[sources], low)
+        np.minimum.at(hooked, labels[targets], low)
+        while True:
+            jumped = hooked[hooked]
+            if np.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if np.array_equal(hooked, labels):
+            return labels
+        labels = hooked
+
+
+def _graph_labels(embeddings, ivf, distance_threshold, max_neighbors, n_probe):
+    if ivf is None and len(embeddings) > _agglomerative_max_size:
+        ivf = build_ivf(embeddings)
+    # Distances are euclidean between unit vectors, as in the agglomerative clustering
+    min_similarity = 1 - distance_threshold ** 2 / 2
+    edges = list(_neighbor_edges(embeddings, ivf, min_similarity, max_neighbors, n_probe))
+    return _connected_components(len(embeddings), edges)
 
+
+def _avg_distance(vectors):
+    # Mean pairwise squared euclidean distance from the sums of the member
+    # vectors, without comparing every pair: sum_ij |vi - vj|^2 = 2n sum_i |vi|^2 - 2|sum_i vi|^2
+    vectors = np.asarray(vectors, dtype=np.float64)
+    n = len(vectors)
+    squared = (2 * n * np.sum(vectors * vectors) - 2 * np.sum(vectors.sum(axis=0) ** 2)) / (n * (n - 1))
+    return float(np.sqrt(squared)) if squared > 1e-6 else 0
+
+
+def _get_clusters(index, distance_threshold, method='auto', max_neighbors=10, n_probe=16):
+    # Long units are clustered by their first window
+    units = index.units
+    embeddings = index.embeddings if units is None else index.embeddings[units]
+    if method == 'agglomerative' or (method == 'auto' and len(embeddings) <= _agglomerative_max_size):
+        labels = _agglomerative_labels(embeddings, distance_threshold)
+    else:
+        labels = _graph_labels(embeddings, index.ivf if units is None else None, distance_threshold,
+                               max_neighbors, n_probe)
+
+    order = np.argsort(labels, kind='stable')
+    _, starts, sizes = np.unique(labels[order], return_index=True, return_counts=True)
+    clusters = []
+    for start, size in sorted(zip(starts, sizes), key=lambda c: order[c[0]]):
+        # filter out clusters with only one function
+        if size < 2:
+            continue
+        members = np.sort(order[start:start + size])
+        if units is not None:
+            members = units[members]
+        clusters.append({'avg_distance': _avg_distance(index.embeddings[members]),
+                         'functions': [index.function(idx) for idx in members]})
     return clusters
 
 
 def do_cluster(args, model):
-    if not os.path.isfile(args.path_to_repo + '/' + '.embeddings'):
+    with profiling.stage('load index') as counts:
+        index = load_index(args.path_to_repo)
+        counts['functions'] = len(index) if index is not None else 0
+    if index is None:
         print('Embeddings not found in {}. Generating embeddings now.'.format(
             args.path_to_repo))
-        do_embed(args, model)
-
-    with gzip.open(args.path_to_repo + '/' + '.embeddings', 'r') as f:
-        dataset = pickle.loads(f.read())
-        if dataset.get('model_name') != args.model_name_or_path:
-            print('Model name mismatch. Regenerating embeddings.')
-            dataset = do_embed(args, model)
-        clusters = _get_clusters(dataset, args.cluster_max_distance)
-
-        filtered_clusters = []
-        for c in (clusters):
-            if args.cluster_ignore_identincal and c.get('avg_distance') == 0:
-                continue
-            if any([len(f.get('text').split('\n')) <= args.cluster_min_lines for f in c.get('functions')]):
-                continue
-            if len(c.get('functions')) < args.cluster_min_cluster_size:
-                continue
-            filtered_clusters.append(c)
-
-        for i, c in enumerate(filtered_clusters):
-            print('Cluster #{}: avg_distance: {:.3} ================================================\n'.format(
-                i, c.get('avg_distance')))
-            # print('avg_distance:', c.get('avg_distance'))
-            for f in c.get('functions'):
-                print(indent(f.get('file'), '    ') + ':' + str(f.get('line')))
-                print(indent(f.get('text'), '    ') + '\n')
+        index = do_embed(args, model)
+    elif index.model_name != args.model_name_or_path:
+        print('Model name mismatch. Regenerating embeddings.')
+        index = do_embed(args, model)
+    with profiling.stage('cluster', functions=len(index)) as counts:
+        clusters = _get_clusters(index, args.cluster_max_distance, args.cluster_method,
+                                 args.cluster_neighbors, args.ann_probe)
+        counts['clusters'] = len(clusters)
+
+    filtered_clusters = []
+    for c in (clusters):
+        if args.cluster_ignore_identincal and c.get('avg_distance') == 0:
+            continue
+        if any([len(f.get('text').split('\n')) <= args.cluster_min_lines for f in c.get('functions')]):
+            continue
+        if len(c.get('functions')) < args.cluster_min_cluster_size:
+            continue
+        filtered_clusters.append(c)
+
+    for i, c in enumerate(filtered_clusters):
+        print('Cluster #{}: avg_distance: {:.3} ================================================\n'.format(
+            i, c.get('avg_distance')))
+        # print('avg_distance:', c.get('avg_distance'))
+        for f in c.get('functions'):
+            print(indent(f.get('file'), '    ') + ':' + str(f.get('line')))
+            print(indent(f.get('text'), '    ') + '\n')
@@ -1,99 +1,321 @@
-import gzip
+import hashlib
+import json
 import os
 import sys
-import pickle
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from subprocess import run
 from textwrap import dedent
 
 import numpy as np
-from tree_sitter import Tree
-from tree_sitter_languages import get_parser
+from tree_sitter_languages import get_language, get_parser
 from tqdm import tqdm
 
+from semantic_code_search import profiling
+from semantic_code_search.batching import EncodeStats, encode_batched
+from semantic_code_search.chunking import chunk_units
+from semantic_code_search.index import IndexLocked, IndexWriter, load_index, lock_index, unlock_index
+from semantic_code_search.languages import file_extensions, get_languages
 
-def _supported_file_extensions():
-    return {
-        '.rb': 'ruby',
-        '.go': 'go',
-        '.rs': 'rust',
-        '.java': 'java',
-        '.js': 'javascript',
-        '.ts': 'typescript',
-        '.py': 'python',
-        '.c': 'c',
-        '.h': 'c',
-        '.cpp': 'cpp',
-        '.hpp': 'cpp',
-        '.kt': 'kotlin',
-        '.kts': 'kotlin',
-        '.ktm': 'kotlin',
-        '.php': 'php',
-    }
-
-
-def _traverse_tree(tree: Tree):
-    cursor = tree.walk()
-    reached_root = False
-    while reached_root is False:
-        yield cursor.node
-        if cursor.goto_first_child():
-            continue
-        if cursor.goto_next_sibling():
-            continue
-        retracing = True
-        while retracing:
-            if not cursor.goto_parent():
-                retracing = False
-                reached_root = True
-            if cursor.goto_next_sibling():
-                retracing = False
+
+_queries = {}
+
+
+def _get_query(lang, patterns):
+    key = (lang, tuple(patterns))
+    if key not in _queries:
+        language = get_language(lang)
+        try:
+            _queries[key] = language.query('\n'.join(patterns)) if patterns else None
+        except NameError:
+            # The grammar lacks some node or field names, keep the patterns it knows
+            valid = []
+            for pattern in patterns:
+                try:
+                    language.query(pattern)
+                    valid.append(pattern)
+                except NameError:
+                    continue
+            _queries[key] = language.query('\n'.join(valid)) if valid else None
+    return _queries[key]
 
 
-def _extract_functions(nodes, fp, file_content, relevant_node_types):
+def _text_hash(text):
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+def _extract_functions(captures, fp, lang, source):
     out = []
-    for n in nodes:
-        if n.type in relevant_node_types:
-            node_text = dedent('\n'.join(file_content.split('\n')[
-                               n.start_point[0]:n.end_point[0]+1]))
-            out.append(
-                {'file': fp, 'line': n.start_point[0], 'text': node_text})
+    seen = set()
+    for node, kind in captures:
+        if (node.start_byte, node.end_byte) in seen:
+            continue
+        seen.add((node.start_byte, node.end_byte))
+        # Units span whole lines so that dedent sees the original indentation
+        start = source.rfind(b'\n', 0, node.start_byte) + 1
+        end = source.find(b'\n', node.end_byte)
+        node_text = dedent(source[start:end if end != -1 else len(source)].decode('utf8', errors='replace'))
+        out.append({'file': fp, 'line': node.start_point[0], 'language': lang, 'kind': kind,
+                    'text': node_text, 'hash': _text_hash(node_text)})
     return out
 
 
-def _get_repo_functions(root, supported_file_extensions, relevant_node_types):
-    functions = []
-    print('Extracting functions from {}'.format(root))
-    for fp in tqdm([root + '/' + f for f in os.popen('git -C {} ls-files'.format(root)).read().split('\n')]):
-        if not os.path.isfile(fp):
+def _git_ls_files(root, *options):
+    p = run(['git', '-C', root, 'ls-files'] + list(options), capture_output=True)
+    return [f for f in p.stdout.decode('utf-8').split('\n') if f]
+
+
+def _get_repo_files(root):
+    # Maps every tracked file, and every untracked file that is not ignored, to
+    # its git blob sha. Files modified in the working tree are re-hashed so that
+    # the sha always reflects what is on disk, and deleted files are left out.
+    files = {}
+    for entry in _git_ls_files(root, '-s'):
+        if '\t' not in entry:
             continue
-        with open(fp, 'r') as f:
-            lang = supported_file_extensions.get(fp[fp.rfind('.'):])
-            if lang:
-                parser = get_parser(lang)
-                file_content = f.read()
-                tree = parser.parse(bytes(file_content, 'utf8'))
-                all_nodes = list(_traverse_tree(tree.root_node))
-                functions.extend(_extract_functions(
-                    all_nodes, fp, file_content, relevant_node_types))
+        info, path = entry.split('\t', 1)
+        files[root + '/' + path] = info.split()[1]
+    for path in _git_ls_files(root, '-d'):
+        files.pop(root + '/' + path, None)
+
+    untracked = [root + '/' + f for f in _git_ls_files(root, '--others', '--exclude-standard')
+                 if not f.startswith('.embeddings/')]
+    modified = [root + '/' + f for f in _git_ls_files(root, '-m')] + untracked
+    modified = [fp for fp in modified if os.path.isfile(fp)]
+    if modified:
+        p = run(['git', '-C', root, 'hash-object', '--stdin-paths'],
+                input='\n'.join(modified).encode('utf-8'), capture_output=True)
+        files.update(zip(modified, p.stdout.decode('utf-8').split()))
+    return files
+
+
+def _get_file_functions(languages, extensions, fp):
+    lang = extensions.get(fp[fp.rfind('.'):])
+    if not lang or not os.path.isfile(fp):
+        return []
+    query = _get_query(lang, languages[lang]['patterns'])
+    if query is None:
+        return []
+    with open(fp, 'rb') as f:
+        source = f.read()
+    tree = get_parser(lang).parse(source)
+    functions = _extract_functions(query.captures(tree.root_node), fp, lang, source)
+    if not functions and source.strip():
+        # Files without any function or class, such as scripts or configuration
+        # in code, are a single unit
+        text = source.decode('utf8', errors='replace')
+        functions = [{'file': fp, 'line': 0, 'language': lang, 'kind': 'file', 'text': text, 'hash': _text_hash(text)}]
     return functions
 
 
+def _get_chunk_functions(languages, extensions, files):
+    return [_get_file_functions(languages, extensions, fp) for fp in files]
+
+
+def _iter_repo_functions(root, languages, files, jobs=1):
+    # Yields the functions of every file as a list, in the order of `files`
+    # regardless of how many processes are used, so that indexes are reproducible.
+    # Only a few chunks are in flight at a time, so a slow consumer (encoding)
+    # does not let extracted functions pile up in memory.
+    extract = partial(_get_chunk_functions, languages, file_extensions(languages))
+    print('Extracting functions from {}'.format(root))
+    if jobs <= 1 or len(files) < 2:
+        for fp in tqdm(files):
+            yield from extract([fp])
+        return
+    chunksize = max(1, min(64, len(files) // (jobs * 8)))
+    with ProcessPoolExecutor(max_workers=jobs) as executor, tqdm(total=len(files)) as progress:
+        pending = deque()
+        for start in range(0, len(files), chunksize):
+            pending.append(executor.submit(extract, files[start:start + chunksize]))
+            if len(pending) >= jobs * 4:
+                results = pending.popleft().result()
+                progress.update(len(results))
+                yield from results
+        while pending:
+            results = pending.popleft().result()
+            progress.update(len(results))
+            yield from results
+
+
+def _get_repo_functions(root, languages, files=None, jobs=1):
+    if files is None:
+        files = list(_get_repo_files(root))
+    return [f for file_functions in _iter_repo_functions(root, languages, files, jobs)
+            for f in file_functions]
+
+
+def _file_rows(index):
+    # The rows of every file of an index are consecutive, maps the files to
+    # their [start, stop) row ranges
+    file_ids = np.asarray(index.column('file'))
+    if len(file_ids) == 0:
+        return {}
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(file_ids)) + 1])
+    stops = np.append(starts[1:], len(file_ids))
+    paths = index.paths
+    return {index.root + '/' + paths[file_ids[start]][0]: range(start, stop)
+            for start, stop in zip(starts.tolist(), stops.tolist())}
+
+
+def _iter_file_functions(root, languages, files, changed, previous, jobs=1):
+    # Yields the functions of every file in `files`, re-parsing only the files in
+    # `changed`. The others are yielded as the range of their rows in the
+    # previous index, which are copied over as they are.
+    previous_rows = _file_rows(previous) if previous is not None else {}
+    extracted = _iter_repo_functions(root, languages, [fp for fp in files if fp in changed], jobs)
+    for fp in files:
+        if fp in changed:
+            yield next(extracted)
+        else:
+            yield previous_rows.get(fp, range(0))
+
+
+def _embed_shard(functions, model, previous, cached_rows, args, stats):
+    vectors = [None] * len(functions)
+    to_encode = {}
+    for i, f in enumerate(functions):
+        row = cached_rows.get(f['hash'].encode('ascii'))
+        if row is not None:
+            vectors[i] = previous.embeddings[row]
+        else:
+            to_encode.setdefault(f['hash'], []).append(i)
+    if to_encode:
+        encoded = encode_batched(model, [functions[rows[0]].get('chunk_text', functions[rows[0]]['text'])
+                                         for rows in to_encode.values()],
+                                 args.batch_size, args.max_batch_tokens, stats)
+        for rows, v in zip(to_encode.values(), encoded):
+            for i in rows:
+                vectors[i] = v
+    return np.stack(vectors), sum(len(rows) for rows in to_encode.values())
+
+
+def _fingerprint(args, files, languages, previous):
+    # Identifies the inputs of a build, a checkpoint is only resumed if they match
+    h = hashlib.sha1()
+    h.update(json.dumps([args.model_name_or_path, args.dtype, getattr(args, 'chunk_size', None),
+                         getattr(args, 'chunk_overlap', 0), languages, list(files.items()),
+                         previous.path if previous is not None else None]).encode('utf8'))
+    return h.hexdigest()
+
+
+def _embed(args, model, lock):
+    languages = get_languages(getattr(args, 'languages', None))
+    with profiling.stage('list files') as counts:
+        files = _get_repo_files(args.path_to_repo)
+        counts['files'] = len(files)
+
+    previous = None
+    if getattr(args, 'incremental', False):
+        with profiling.stage('load index'):
+            previous = load_index(args.path_to_repo)
+    if previous and previous.model_name == args.model_name_or_path:
+        previous_files = previous.files
+        changed = {fp for fp, sha in files.items() if previous_files.get(fp) != sha}
+        print('{} of {} files changed since the last embedding'.format(len(changed), len(files)))
+        # Functions of changed files whose text is unchanged reuse their vector
+        cached_rows = dict(zip(previous.column('hash').tolist(), range(len(previous)))) if changed else {}
+    else:
+        previous = None
+        changed = set(files)
+        cached_rows = {}
+
+    writer = IndexWriter(args.path_to_repo, args.model_name_or_path, dtype=args.dtype,
+                         ann_lists=args.ann_lists if args.ann else None, ann_min_size=args.ann_min_size,
+                         quantization=getattr(args, 'quantize', None),
+                         fingerprint=_fingerprint(args, files, languages, previous), lock=lock)
+    try:
+        if writer.files_done:
+            print('Resuming from a checkpoint after {} of {} files'.format(writer.files_done, len(files)))
+        remaining = list(files)[writer.files_done:]
+
+        # Functions are encoded and written to disk a shard at a time, with a
+        # checkpoint after every shard, so memory use is bounded by the shard size
+        # and an interrupted run can pick up where it stopped.
+        stats = EncodeStats()
+
+        def write_shard(shard, files_done=None):
+            with profiling.stage('encode') as counts:
+                tokens, batches = stats.tokens, stats.batches
+                vectors, n = _embed_shard(shard, model, previous, cached_rows, args, stats)
+                counts.update(functions=n, tokens=stats.tokens - tokens, batches=stats.batches - batches)
+            with profiling.stage('write', functions=len(shard)):
+                writer.add(shard, vectors)
+                if files_done is not None:
+                    writer.checkpoint(files_done)
+            return n
+
+        def copy_rows(rows):
+            if rows:
+                with profiling.stage('copy', functions=len(rows)):
+                    writer.copy(previous, rows.start, rows.stop)
+
+        shard = []
+        encoded = 0
+        written = writer.count
+        # Parsing is timed from the end of one shard to the end of the next. With
+        # several processes it is the time spent waiting for their results.
+        shard_start, shard_files = time.perf_counter(), writer.files_done
+        files_done = writer.files_done
+        # Rows of unchanged files that follow each other in the previous index
+        # are copied together
+        copying = range(0)
+        try:
+            for files_done, functions in enumerate(_iter_file_functions(
+                    args.path_to_repo, languages, remaining, changed, previous, args.jobs), start=writer.files_done + 1):
+                if isinstance(functions, range):
+                    if copying and functions and copying.stop != functions.start:
+                        copy_rows(copying)
+                        copying = range(0)
+                    if functions:
+                        copying = range(copying.start if copying else functions.start, functions.stop)
+                    continue
+                shard.extend(chunk_units(model, functions, getattr(args, 'chunk_size', None),
+                                         getattr(args, 'chunk_overlap', 0)))
+                if len(shard) >= args.shard_size:
+                    copy_rows(copying)
+                    copying = range(0)
+                    profiling.add('parse', shard_start, files=files_done - shard_files, functions=len(shard))
+                    encoded += write_shard(shard, files_done)
+                    shard = []
+                    shard_start, shard_files = time.perf_counter(), files_done
+            copy_rows(copying)
+            if shard:
+                profiling.add('parse', shard_start, files=files_done - shard_files, functions=len(shard))
+                encoded += write_shard(shard)
+        except KeyboardInterrupt:
+            print('Interrupted. Run the same command again to resume from the last checkpoint.')
+            sys.exit(1)
+
+        if not writer.count:
+            print('No supported languages found in {}. Exiting'.format(args.path_to_repo))
+            sys.exit(1)
+
+        print('Embedded {} functions ({} reused from cache). This is done once and cached in .embeddings'.format(
+            writer.count, writer.count - written - encoded))
+        if stats.functions:
+            print(stats.summary())
+        with profiling.stage('commit', functions=writer.count):
+            return writer.commit(files)
+    finally:
+        # Closes the build if it did not get to commit
+        writer.close()
+
+
 def do_embed(args, model):
-    nodes_to_extract = ['function_definition', 'method_definition',
-                        'function_declaration', 'method_declaration']
-    functions = _get_repo_functions(
-        args.path_to_repo, _supported_file_extensions(), nodes_to_extract)
-
-    if not functions:
-        print('No supported languages found in {}. Exiting'.format(args.path_to_repo))
-        sys.exit(1)
-
-    print('Embedding {} functions in {} batches. This is done once and cached in .embeddings'.format(
-        len(functions), int(np.ceil(len(functions)/args.batch_size))))
-    corpus_embeddings = model.encode(
-        [f['text'] for f in functions], convert_to_tensor=True, show_progress_bar=True, batch_size=args.batch_size)
-
-    dataset = {'functions': functions,
-               'embeddings': corpus_embeddings, 'model_name': args.model_name_or_path}
-    with gzip.open(args.path_to_repo + '/' + '.embeddings', 'w') as f:
-        f.write(pickle.dumps(dataset))
-    return dataset
+    try:
+        lock = lock_index(args.path_to_repo)
+    except IndexLocked:
+        if not getattr(args, 'wait_for_lock', False):
+            print('The index of {} is being built by another process (sem --embed or sem --watch). '
+                  'Run this again once it is done'.format(args.path_to_repo))
+            sys.exit(1)
+        print('Waiting for another process to finish building the index of {}'.format(args.path_to_repo))
+        lock = lock_index(args.path_to_repo, wait=True)
+    # The lock covers the whole build, from listing the files to the commit
+    try:
+        return _embed(args, model, lock)
+    finally:
+        unlock_index(lock)
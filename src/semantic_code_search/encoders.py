@@ -0,0 +1,210 @@
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+from semantic_code_search.ann import normalize
+from semantic_code_search.query_cache import cache_dir
+
+# Encoders are interchangeable with a SentenceTransformer as far as the rest of
+# the code is concerned: they have `encode`, `tokenizer` and `max_seq_length`.
+#   torch: the SentenceTransformer itself, in eager PyTorch
+#   onnx:  the transformer exported to ONNX once and run with ONNX Runtime, with
+#          the pooling of the SentenceTransformer done in numpy. The export is
+#          only used if its scores match the PyTorch model within tolerance.
+
+BACKENDS = ['torch', 'onnx']
+
+# Texts the ONNX export is compared on, a mix of queries and code
+_parity_texts = [
+    'Where are API requests authenticated?',
+    'Saving user objects to the database',
+    'read jobs from the queue',
+    'def add(a, b):\n    return a + b',
+    'function parseArgs(argv) {\n  return argv.slice(2).map(a => a.trim());\n}',
+    'func (s *Server) Close() error {\n\treturn s.listener.Close()\n}',
+    'public int size() {\n    return this.items.length;\n}',
+    'fn main() {\n    println!("hello");\n}',
+]
+
+_parity_tolerance = {'model.onnx': 1e-3, 'model.int8.onnx': 5e-2}
+
+
+def encoder_name(args):
+    # Identifies the vectors an encoder produces, e.g. for the query cache
+    backend = getattr(args, 'backend', 'torch')
+    if backend == 'onnx':
+        return '{} (onnx{})'.format(args.model_name_or_path, ', int8' if args.onnx_quantize else '')
+    return args.model_name_or_path
+
+
+def _sentence_transformer(args):
+    import torch
+    from sentence_transformers import SentenceTransformer
+    if getattr(args, 'threads', 0):
+        torch.set_num_threads(args.threads)
+    return SentenceTransformer(args.model_name_or_path, device='cpu' if getattr(args, 'backend', None) == 'onnx' else None)
+
+
+def _pool(hidden, attention_mask, pooling):
+    # Same as the sentence_transformers Pooling module: the enabled modes are
+    # concatenated in this order
+    mask = attention_mask[:, :, None].astype(np.float32)
+    parts = []
+    if pooling.get('pooling_mode_cls_token'):
+        parts.append(hidden[:, 0])
+    if pooling.get('pooling_mode_max_tokens'):
+        parts.append(np.where(mask > 0, hidden, -1e9).max(axis=1))
+    if pooling.get('pooling_mode_mean_tokens') or pooling.get('pooling_mode_mean_sqrt_len_tokens'):
+        sums = (hidden * mask).sum(axis=1)
+        counts = np.maximum(mask.sum(axis=1), 1e-9)
+        if pooling.get('pooling_mode_mean_tokens'):
+            parts.append(sums / counts)
+        if pooling.get('pooling_mode_mean_sqrt_len_tokens'):
+            parts.append(sums / np.sqrt(counts))
+    return np.concatenate(parts, axis=1).astype(np.float32)
+
+
+class OnnxEncoder():
+
+    def __init__(self, path, model_file, threads=0):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(path, 'export.json'), 'r') as f:
+            self.config = json.load(f)
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.max_seq_length = self.config.get('max_seq_length')
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(os.path.join(path, model_file), options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, show_progress_bar=False, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            encoded = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                     max_length=self.max_seq_length, return_tensors='np')
+            hidden = self.session.run(None, {name: encoded[name].astype(np.int64) for name in self.input_names})[0]
+            vectors.append(_pool(hidden, encoded['attention_mask'], self.config.get('pooling')))
+        vectors = np.concatenate(vectors) if vectors else np.zeros((0, self.config.get('dim')), dtype=np.float32)
+        if self.config.get('normalize'):
+            vectors = normalize(vectors)
+        return vectors[0] if single else vectors
+
+
+def check_parity(reference, candidate, texts=_parity_texts):
+    # Compares the cosine scores between all pairs of texts. Both the largest
+    # difference of a pairwise score and the smallest cosine between the two
+    # encoders' vectors of the same text are reported.
+    a = normalize(np.asarray(reference.encode(texts, convert_to_numpy=True), dtype=np.float32))
+    b = normalize(np.asarray(candidate.encode(texts, convert_to_numpy=True), dtype=np.float32))
+    return {'max_score_difference': float(np.abs(a @ a.T - b @ b.T).max()),
+            'min_cosine': float((a * b).sum(axis=1).min())}
+
+
+def _onnx_dir(model_name):
+    return os.path.join(cache_dir(), 'onnx', re.sub(r'[^A-Za-z0-9_.-]+', '--', model_name.strip('/')))
+
+
+def _export_onnx(args, path, model_file):
+    import torch
+
+    print('Exporting {} to ONNX in {}'.format(args.model_name_or_path, path))
+    st = _sentence_transformer(args)
+    modules = [type(m).__name__ for m in st]
+    if modules[:2] != ['Transformer', 'Pooling'] or set(modules[2:]) - {'Normalize'}:
+        print('The onnx backend only supports models made of a transformer, pooling and normalization, '
+              '{} has {}'.format(args.model_name_or_path, ', '.join(modules)))
+        sys.exit(1)
+    os.makedirs(path, exist_ok=True)
+    config_path = os.path.join(path, 'export.json')
+    config = {}
+    if os.path.isfile(config_path):
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+
+    if not os.path.isfile(os.path.join(path, 'model.onnx')):
+        transformer = st[0].auto_model.eval()
+        tokenizer = st.tokenizer
+        example = tokenizer(_parity_texts[:2], padding=True, return_tensors='pt')
+        input_names = [name for name in ['input_ids', 'attention_mask', 'token_type_ids'] if name in example]
+
+        class LastHiddenState(torch.nn.Module):
+
+            def __init__(self):
+                super().__init__()
+                self.transformer = transformer
+
+            def forward(self, *inputs):
+                return self.transformer(**dict(zip(input_names, inputs)))[0]
+
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']}
+        with torch.no_grad():
+            torch.onnx.export(LastHiddenState(), tuple(example[name] for name in input_names),
+                              os.path.join(path, 'model.tmp.onnx'), input_names=input_names,
+                              output_names=['last_hidden_state'], dynamic_axes=dynamic_axes,
+                              opset_version=14, do_constant_folding=True)
+        os.replace(os.path.join(path, 'model.tmp.onnx'), os.path.join(path, 'model.onnx'))
+        # The tokenizer is loaded from the export, without sentence_transformers
+        tokenizer.save_pretrained(path)
+        transformer.config.save_pretrained(path)
+        config.update({'model_name': args.model_name_or_path, 'max_seq_length': st.max_seq_length,
+                       'dim': st.get_sentence_embedding_dimension(), 'pooling': st[1].get_config_dict(),
+                       'normalize': 'Normalize' in modules, 'parity': {}})
+        with open(config_path, 'w') as f:
+            json.dump(config, f)
+
+    if model_file == 'model.int8.onnx' and not os.path.isfile(os.path.join(path, model_file)):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(os.path.join(path, 'model.onnx'), os.path.join(path, 'model.int8.tmp.onnx'),
+                         weight_type=QuantType.QInt8)
+        os.replace(os.path.join(path, 'model.int8.tmp.onnx'), os.path.join(path, model_file))
+
+    parity = check_parity(st, OnnxEncoder(path, model_file, getattr(args, 'threads', 0)))
+    config['parity'][model_file] = parity
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    print('Parity with PyTorch: max score difference {:.2e} (tolerance {:.0e}), min cosine {:.6f}'.format(
+        parity['max_score_difference'], _tolerance(args, model_file), parity['min_cosine']))
+
+
+def _tolerance(args, model_file):
+    if getattr(args, 'parity_tolerance', None) is not None:
+        return args.parity_tolerance
+    return _parity_tolerance[model_file]
+
+
+def _onnx_encoder(args):
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        print('The onnx backend needs onnxruntime, install it with `pip install semantic-code-search[onnx]`')
+        sys.exit(1)
+    path = _onnx_dir(args.model_name_or_path)
+    model_file = 'model.int8.onnx' if args.onnx_quantize else 'model.onnx'
+    parity = None
+    if os.path.isfile(os.path.join(path, 'export.json')):
+        with open(os.path.join(path, 'export.json'), 'r') as f:
+            parity = json.load(f).get('parity', {}).get(model_file)
+    if parity is None or not os.path.isfile(os.path.join(path, model_file)):
+        _export_onnx(args, path, model_file)
+        with open(os.path.join(path, 'export.json'), 'r') as f:
+            parity = json.load(f).get('parity').get(model_file)
+    if parity['max_score_difference'] > _tolerance(args, model_file):
+        print('The ONNX export in {} does not match the PyTorch model (max score difference {:.2e}), '
+              'use --backend torch or raise --parity-tolerance'.format(path, parity['max_score_difference']))
+        sys.exit(1)
+    return OnnxEncoder(path, model_file, getattr(args, 'threads', 0))
+
+
+def load_encoder(args):
+    if getattr(args, 'backend', 'torch') == 'onnx':
+        return _onnx_encoder(args)
+    return _sentence_transformer(args)
@@ -0,0 +1,393 @@
+import json
+import os
+import shutil
+import tempfile
+from fnmatch import fnmatch
+from functools import cached_property
+
+import numpy as np
+
+from semantic_code_search.ann import build_ivf, load_ivf, normalize, save_ivf
+from semantic_code_search.quantize import load_quantized, quantize
+
+try:
+    import fcntl
+except ImportError:  # Windows, builds are not serialized there
+    fcntl = None
+
+INDEX_VERSION = 5
+
+# Per-row metadata is stored column by column, so that filters only read the
+# columns they need. Attributes shared by all rows of a file (path, extension,
+# language) live in files.json and are referenced by the `file` column.
+# Long units are stored as several consecutive rows, one per window of the unit,
+# numbered by `chunk` and sharing the unit's text.
+_columns = {
+    'file': np.dtype(np.int32),
+    'line': np.dtype(np.int32),
+    'lines': np.dtype(np.int32),
+    'kind': np.dtype('S16'),
+    'text_offset': np.dtype(np.int64),
+    'text_length': np.dtype(np.int64),
+    'hash': np.dtype('S40'),
+    'chunk': np.dtype(np.int32),
+}
+
+
+def index_dir(root):
+    return root + '/' + '.embeddings'
+
+
+class IndexLocked(Exception):
+    pass
+
+
+# Only one build of the index of a repo runs at a time, `sem --watch` and
+# `sem --embed` would otherwise write into the same build directory. The lock
+# is an flock on .embeddings/lock, so it is released by the OS if the process
+# dies, and two builds in the same process exclude each other as well.
+def lock_index(root, wait=False):
+    path = index_dir(root)
+    if os.path.isfile(path):
+        # Indexes created by older versions are a single gzipped pickle
+        os.remove(path)
+    os.makedirs(path, exist_ok=True)
+    f = open(path + '/lock', 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            f.close()
+            raise IndexLocked(root)
+    return f
+
+
+def unlock_index(lock):
+    # Closing the file releases the flock
+    lock.close()
+
+
+# A read-only generation of the on-disk index. The embedding matrix is
+# memory-mapped and all other metadata is loaded on first access, so opening an
+# index is cheap regardless of its size. Function text is only read for the rows
+# that are actually returned.
+class Index():
+
+    def __init__(self, root, path):
+        self.root = root
+        self.path = path
+        with open(path + '/meta.json', 'r') as f:
+            self.meta = json.load(f)
+        self.model_name = self.meta.get('model_name')
+
+    def __len__(self):
+        return self.meta.get('count')
+
+    @cached_property
+    def embeddings(self):
+        return np.memmap(self.path + '/vectors.bin', dtype=self.meta.get('dtype'), mode='r',
+                         shape=(self.meta.get('count'), self.meta.get('dim')))
+
+    @cached_property
+    def ivf(self):
+        if not self.meta.get('ann'):
+            return None
+        return load_ivf(self.path)
+
+    @cached_property
+    def quantized(self):
+        if not self.meta.get('quantization'):
+            return None
+        return load_quantized(self.path, self.meta['quantization']['type'])
+
+    @cached_property
+    def _column_cache(self):
+        return {}
+
+    def column(self, name):
+        if name not in self._column_cache:
+            self._column_cache[name] = np.memmap(self.path + '/' + name + '.col', dtype=_columns[name],
+                                                 mode='r', shape=(self.meta.get('count'),))
+        return self._column_cache[name]
+
+    @cached_property
+    def paths(self):
+        with open(self.path + '/files.json', 'r') as f:
+            return json.load(f)
+
+    @cached_property
+    def files(self):
+        return {self.root + '/' + path: sha for path, sha, _ in self.paths}
+
+    @cached_property
+    def _selections(self):
+        return {}
+
+    def select(self, file_extension=None, language=None, path_glob=None):
+        # Returns the ids of the rows matching all of the given filters, or None
+        # if no filter is given. Filters are evaluated once per file and then
+        # mapped onto the rows through the file column.
+        if not (file_extension or language or path_glob):
+            return None
+        if file_extension and not file_extension.startswith('.'):
+            file_extension = '.' + file_extension
+        key = (file_extension, language, path_glob)
+        if key not in self._selections:
+            selected = np.array([(not file_extension or path.endswith(file_extension)) and
+                                 (not language or lang == language) and
+                                 (not path_glob or fnmatch(path, path_glob))
+                                 for path, _, lang in self.paths], dtype=bool)
+            self._selections[key] = np.flatnonzero(selected[self.column('file')])
+        return self._selections[key]
+
+    @cached_property
+    def units(self):
+        # The first row of every unit, or None if every unit is a single row
+        if not self.meta.get('chunked'):
+            return None
+        return np.flatnonzero(self.column('chunk') == 0)
+
+    def unit_rows(self, rows):
+        # Maps rows to the first row of their unit
+        if not self.meta.get('chunked'):
+            return rows
+        return rows - self.column('chunk')[rows]
+
+    @cached_property
+    def _text(self):
+        if os.path.getsize(self.path + '/text.bin') == 0:
+            return b''
+        return np.memmap(self.path + '/text.bin', dtype=np.uint8, mode='r')
+
+    def function(self, idx):
+        path, _, language = self.paths[self.column('file')[idx]]
+        offset, length = int(self.column('text_offset')[idx]), int(self.column('text_length')[idx])
+        return {'file': self.root + '/' + path,
+                'line': int(self.column('line')[idx]),
+                'language': language,
+                'kind': self.column('kind')[idx].decode('ascii'),
+                'text': bytes(self._text[offset:offset + length]).decode('utf8'),
+                'hash': self.column('hash')[idx].decode('ascii'),
+                'chunk': int(self.column('chunk')[idx])}
+
+    def functions(self):
+        for idx in range(len(self)):
+            yield self.function(idx)
+
+
+def _open_truncated(path, size):
+    f = open(path, 'r+b' if size else 'wb')
+    f.truncate(size)
+    f.seek(size)
+    return f
+
+
+# Writes a new index generation into a build directory next to the current one.
+# Rows are appended with `add` and `checkpoint` records how far the build got,
+# so that an interrupted build with the same fingerprint resumes from there.
+# Nothing is visible to readers until `commit` atomically switches the CURRENT
+# pointer to the new generation.
+class IndexWriter():
+
+    def __init__(self, root, model_name, dtype='float32', ann_lists=None, ann_min_size=0, quantization=None,
+                 fingerprint=None, lock=None):
+        self.root = root
+        self.model_name = model_name
+        self.dtype = dtype
+        self.quantization = quantization
+        self.ann_lists = ann_lists
+        self.ann_min_size = ann_min_size
+        self.fingerprint = fingerprint
+        self.path = index_dir(root) + '/build'
+        self.dim = None
+        self.count = 0
+        self.files_done = 0
+        self.file_ids = {}
+        self.file_languages = []
+        self.text_offset = 0
+        self.chunked = False
+        self._unit_text = None
+        # A build holds the lock of the index until it is committed or closed,
+        # unless the caller holds it already
+        self._lock = lock_index(root) if lock is None else None
+
+        progress = None
+        if fingerprint is not None and os.path.isfile(self.path + '/progress.json'):
+            with open(self.path + '/progress.json', 'r') as f:
+                progress = json.load(f)
+        if progress and progress.get('fingerprint') == fingerprint:
+            self.dim = progress.get('dim')
+            self.count = progress.get('count')
+            self.files_done = progress.get('files_done')
+            self.file_ids = {fp: i for i, (fp, _) in enumerate(progress.get('files'))}
+            self.file_languages = [language for _, language in progress.get('files')]
+            self.text_offset = progress.get('text_bytes')
+            self.chunked = progress.get('chunked', False)
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+        # Anything written after the last checkpoint is discarded
+        self._vectors = _open_truncated(self.path + '/vectors.bin',
+                                        self.count * (self.dim or 0) * np.dtype(self.dtype).itemsize)
+        self._columns = {name: _open_truncated(self.path + '/' + name + '.col', self.count * dtype.itemsize)
+                         for name, dtype in _columns.items()}
+        self._text = _open_truncated(self.path + '/text.bin', self.text_offset)
+
+    def _file_id(self, fp, language):
+        if fp not in self.file_ids:
+            self.file_ids[fp] = len(self.file_ids)
+            self.file_languages.append(language)
+        return self.file_ids[fp]
+
+    def _files(self):
+        return [self._vectors, self._text] + list(self._columns.values())
+
+    def add(self, functions, vectors):
+        vectors = normalize(np.asarray(vectors, dtype=np.float32))
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        self._vectors.write(vectors.astype(self.dtype).tobytes())
+        columns = {name: [] for name in _columns}
+        for f in functions:
+            if f.get('chunk', 0) == 0:
+                text = f['text'].encode('utf8')
+                self._text.write(text)
+                self._unit_text = (self.text_offset, len(text))
+                self.text_offset += len(text)
+            else:
+                # Further windows of the unit of the previous row
+                self.chunked = True
+            columns['file'].append(self._file_id(f['file'], f['language']))
+            columns['line'].append(f['line'])
+            columns['lines'].append(f['text'].count('\n') + 1)
+            columns['kind'].append(f['kind'])
+            columns['text_offset'].append(self._unit_text[0])
+            columns['text_length'].append(self._unit_text[1])
+            columns['hash'].append(f['hash'])
+            columns['chunk'].append(f.get('chunk', 0))
+        for name, values in columns.items():
+            self._columns[name].write(np.array(values, dtype=_columns[name]).tobytes())
+        self.count += len(functions)
+
+    def copy(self, index, start, stop):
+        # Appends the rows [start, stop) of another generation, which must hold
+        # all rows of the files they belong to. Vectors, columns and text are
+        # copied as slices, without decoding the rows.
+        if start == stop:
+            return
+        if self.dim is None:
+            self.dim = index.meta.get('dim')
+        self._vectors.write(np.asarray(index.embeddings[start:stop]).astype(self.dtype).tobytes())
+        file_ids = np.asarray(index.column('file')[start:stop])
+        old_ids = np.unique(file_ids)
+        new_ids = np.zeros(old_ids[-1] + 1, dtype=np.int32)
+        for old_id in old_ids.tolist():
+            path, _, language = index.paths[old_id]
+            new_ids[old_id] = self._file_id(self.root + '/' + path, language)
+        offsets = np.asarray(index.column('text_offset')[start:stop])
+        text_start = int(offsets[0])
+        text_end = int((offsets + index.column('text_length')[start:stop]).max())
+        self._text.write(bytes(index._text[text_start:text_end]))
+        for name, dtype in _columns.items():
+            if name == 'file':
+                values = new_ids[file_ids]
+            elif name == 'text_offset':
+                values = offsets - text_start + self.text_offset
+            else:
+                values = index.column(name)[start:stop]
+            self._columns[name].write(np.asarray(values, dtype=dtype).tobytes())
+        self.text_offset += text_end - text_start
+        if index.meta.get('chunked') and index.column('chunk')[start:stop].any():
+            self.chunked = True
+        self.count += stop - start
+
+    def checkpoint(self, files_done):
+        for f in self._files():
+            f.flush()
+            os.fsync(f.fileno())
+        self.files_done = files_done
+        files = [None] * len(self.file_ids)
+        for fp, idx in self.file_ids.items():
+            files[idx] = [fp, self.file_languages[idx]]
+        with open(self.path + '/progress.json.tmp', 'w') as f:
+            json.dump({'fingerprint': self.fingerprint, 'dim': self.dim, 'count': self.count,
+                       'files_done': files_done, 'files': files, 'text_bytes': self.text_offset,
+                       'chunked': self.chunked}, f)
+        os.replace(self.path + '/progress.json.tmp', self.path + '/progress.json')
+
+    def close(self):
+        # Ends the build without committing it, a later build with the same
+        # fingerprint resumes from its last checkpoint
+        for f in self._files():
+            f.close()
+        if self._lock is not None:
+            unlock_index(self._lock)
+            self._lock = None
+
+    def commit(self, files):
+        for f in self._files():
+            f.close()
+        paths = [None] * len(self.file_ids)
+        for fp, idx in self.file_ids.items():
+            paths[idx] = [os.path.relpath(fp, self.root), files.get(fp), self.file_languages[idx]]
+        # Files without any functions are still recorded so that incremental
+        # runs know they have already been processed.
+        paths.extend([os.path.relpath(fp, self.root), sha, None]
+                     for fp, sha in files.items() if fp not in self.file_ids)
+        with open(self.path + '/files.json', 'w') as f:
+            json.dump(paths, f)
+        meta = {'version': INDEX_VERSION, 'model_name': self.model_name, 'dim': self.dim,
+                'count': self.count, 'dtype': self.dtype, 'normalized': True, 'chunked': self.chunked}
+        vectors = None
+        if self.count:
+            vectors = np.memmap(self.path + '/vectors.bin', dtype=self.dtype,
+                                mode='r', shape=(self.count, self.dim))
+        if vectors is not None and self.ann_lists is not None and self.count >= self.ann_min_size:
+            # Small indexes are searched exhaustively, which is both exact and fast enough
+            ivf = build_ivf(vectors, self.ann_lists or None)
+            save_ivf(self.path, ivf)
+            meta['ann'] = {'type': 'ivf', 'lists': len(ivf['centroids'])}
+        if vectors is not None and self.quantization:
+            quantize(vectors, self.quantization, self.path)
+            meta['quantization'] = {'type': self.quantization}
+        del vectors
+        with open(self.path + '/meta.json', 'w') as f:
+            json.dump(meta, f)
+        if os.path.isfile(self.path + '/progress.json'):
+            os.remove(self.path + '/progress.json')
+
+        generation = tempfile.mkdtemp(prefix='gen-', dir=index_dir(self.root))
+        os.rmdir(generation)
+        os.rename(self.path, generation)
+        current = index_dir(self.root) + '/CURRENT'
+        previous = None
+        if os.path.isfile(current):
+            with open(current, 'r') as f:
+                previous = f.read().strip()
+        with open(current + '.tmp', 'w') as f:
+            f.write(os.path.basename(generation))
+        os.replace(current + '.tmp', current)
+        _remove_stale_generations(self.root, [os.path.basename(generation), previous])
+        self.close()
+        return Index(self.root, generation)
+
+
+def _remove_stale_generations(root, keep):
+    # The generation that was current until now is kept around for readers that
+    # opened it but have not mapped its files yet.
+    for name in os.listdir(index_dir(root)):
+        path = index_dir(root) + '/' + name
+        if name not in keep and os.path.isfile(path + '/meta.json'):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def load_index(root):
+    try:
+        with open(index_dir(root) + '/CURRENT', 'r') as f:
+            path = index_dir(root) + '/' + f.read().strip()
+        index = Index(root, path)
+    except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+        return None
+    if index.meta.get('version') != INDEX_VERSION:
+        return None
+    return index
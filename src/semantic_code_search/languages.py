@@ -0,0 +1,140 @@
+import json
+
+# Tree-sitter query patterns selecting the code units that are embedded for each
+# language. Every pattern captures one node and the capture name is recorded as
+# the kind of the unit (function, method, class). Additional patterns and
+# languages can be supplied without code changes in a JSON file of the same
+# shape, passed with --languages.
+#
+# Patterns that a grammar does not know (node names differ between grammar
+# versions) are skipped rather than failing the whole language.
+_languages = {
+    'python': {
+        'extensions': ['.py'],
+        'patterns': [
+            '(function_definition) @function',
+            '(class_definition) @class',
+        ],
+    },
+    'javascript': {
+        'extensions': ['.js', '.jsx', '.mjs', '.cjs'],
+        'patterns': [
+            '(function_declaration) @function',
+            '(generator_function_declaration) @function',
+            '(variable_declarator value: (arrow_function)) @function',
+            '(variable_declarator value: (function)) @function',
+            '(variable_declarator value: (function_expression)) @function',
+            '(method_definition) @method',
+            '(class_declaration) @class',
+        ],
+    },
+    'typescript': {
+        'extensions': ['.ts'],
+        'patterns': [
+            '(function_declaration) @function',
+            '(generator_function_declaration) @function',
+            '(variable_declarator value: (arrow_function)) @function',
+            '(variable_declarator value: (function)) @function',
+            '(variable_declarator value: (function_expression)) @function',
+            '(method_definition) @method',
+            '(class_declaration) @class',
+            '(abstract_class_declaration) @class',
+        ],
+    },
+    'tsx': {
+        'extensions': ['.tsx'],
+        'patterns': [
+            '(function_declaration) @function',
+            '(variable_declarator value: (arrow_function)) @function',
+            '(variable_declarator value: (function)) @function',
+            '(variable_declarator value: (function_expression)) @function',
+            '(method_definition) @method',
+            '(class_declaration) @class',
+        ],
+    },
+    'ruby': {
+        'extensions': ['.rb'],
+        'patterns': [
+            '(method) @method',
+            '(singleton_method) @method',
+            '(class) @class',
+        ],
+    },
+    'go': {
+        'extensions': ['.go'],
+        'patterns': [
+            '(function_declaration) @function',
+            '(method_declaration) @method',
+            '(short_var_declaration right: (expression_list (func_literal))) @function',
+            '(var_declaration (var_spec value: (expression_list (func_literal)))) @function',
+        ],
+    },
+    'rust': {
+        'extensions': ['.rs'],
+        'patterns': [
+            '(function_item) @function',
+            '(let_declaration value: (closure_expression)) @function',
+            '(impl_item) @class',
+            '(trait_item) @class',
+        ],
+    },
+    'java': {
+        'extensions': ['.java'],
+        'patterns': [
+            '(method_declaration) @method',
+            '(constructor_declaration) @method',
+            '(class_declaration) @class',
+            '(record_declaration) @class',
+        ],
+    },
+    'c': {
+        'extensions': ['.c', '.h'],
+        'patterns': [
+            '(function_definition) @function',
+        ],
+    },
+    'cpp': {
+        'extensions': ['.cpp', '.hpp', '.cc', '.hh', '.cxx'],
+        'patterns': [
+            '(function_definition) @function',
+            '(declaration declarator: (init_declarator value: (lambda_expression))) @function',
+            '(class_specifier body: (field_declaration_list)) @class',
+        ],
+    },
+    'kotlin': {
+        'extensions': ['.kt', '.kts', '.ktm'],
+        'patterns': [
+            '(function_declaration) @function',
+            '(property_declaration (lambda_literal)) @function',
+            '(secondary_constructor) @method',
+            '(class_declaration) @class',
+            '(object_declaration) @class',
+        ],
+    },
+    'php': {
+        'extensions': ['.php'],
+        'patterns': [
+            '(function_definition) @function',
+            '(assignment_expression right: (anonymous_function_creation_expression)) @function',
+            '(method_declaration) @method',
+            '(class_declaration) @class',
+            '(trait_declaration) @class',
+        ],
+    },
+}
+
+
+def get_languages(config_path=None):
+    languages = {name: {'extensions': list(lang['extensions']), 'patterns': list(lang['patterns'])}
+                 for name, lang in _languages.items()}
+    if config_path:
+        with open(config_path, 'r') as f:
+            for name, lang in json.load(f).items():
+                entry = languages.setdefault(name, {'extensions': [], 'patterns': []})
+                entry['extensions'].extend(e for e in lang.get('extensions', []) if e not in entry['extensions'])
+                entry['patterns'].extend(p for p in lang.get('patterns', []) if p not in entry['patterns'])
+    return languages
+
+
+def file_extensions(languages):
+    return {ext: name for name, lang in languages.items() for ext in lang['extensions']}
@@ -0,0 +1,152 @@
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# With --profile every stage of a run (listing files, parsing, encoding,
+# writing the index, scoring, clustering, ...) is recorded with its wall time,
+# what it processed and the peak memory of the process when it ended. Stages
+# that run many times, such as encoding a shard, are added up in the summary
+# and kept separate in the trace, which uses the Chrome trace event format
+# (chrome://tracing, https://ui.perfetto.dev) so that traces of many runs can
+# be loaded or aggregated with the same tools.
+#
+# Recording is off unless `enable` was called, stages are then no-ops.
+
+_profile = None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class Profile():
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stages = []
+
+    def add(self, name, start, counts):
+        end = time.perf_counter()
+        with self.lock:
+            self.stages.append({'name': name, 'start': start - self.start, 'seconds': end - start,
+                                'thread': threading.get_ident(), 'peak_rss_mb': peak_rss_mb(),
+                                'counts': {k: v for k, v in counts.items() if v is not None}})
+
+    def summary(self):
+        # Stages in the order they first ran, with the times and counts of all
+        # their runs added up
+        totals = {}
+        for stage in self.stages:
+            total = totals.setdefault(stage['name'], {'calls': 0, 'seconds': 0, 'peak_rss_mb': None, 'counts': {}})
+            total['calls'] += 1
+            total['seconds'] += stage['seconds']
+            if stage['peak_rss_mb'] is not None:
+                total['peak_rss_mb'] = max(total['peak_rss_mb'] or 0, stage['peak_rss_mb'])
+            for k, v in stage['counts'].items():
+                total['counts'][k] = total['counts'].get(k, 0) + v
+        return totals
+
+    def table(self):
+        elapsed = time.perf_counter() - self.start
+        rows = [('stage', 'calls', 'seconds', 'share', 'peak MB', 'counts')]
+        for name, total in self.summary().items():
+            rows.append((name, str(total['calls']), '{:.3f}'.format(total['seconds']),
+                         '{:.1%}'.format(total['seconds'] / max(elapsed, 1e-9)),
+                         '-' if total['peak_rss_mb'] is None else '{:.1f}'.format(total['peak_rss_mb']),
+                         ' '.join('{}={}'.format(k, v) for k, v in total['counts'].items())))
+        rows.append(('total', '', '{:.3f}'.format(elapsed), '', '-' if peak_rss_mb() is None else
+                     '{:.1f}'.format(peak_rss_mb()), ''))
+        widths = [max(len(row[i]) for row in rows) for i in range(5)]
+        lines = []
+        for row in rows:
+            cells = [row[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(row[1:5], widths[1:])]
+            lines.append('  '.join(cells + [row[5]]).rstrip())
+        return '\n'.join(lines)
+
+    def trace(self):
+        # Complete events ("ph": "X") in microseconds. Stages overlap when they
+        # are nested or run in other threads, such as the shards of a workspace.
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for stage in self.stages:
+            tid = threads.setdefault(stage['thread'], len(threads))
+            args = dict(stage['counts'])
+            if stage['peak_rss_mb'] is not None:
+                args['peak_rss_mb'] = stage['peak_rss_mb']
+            events.append({'name': stage['name'], 'cat': 'sem', 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': round(stage['start'] * 1e6, 1), 'dur': round(stage['seconds'] * 1e6, 1),
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'command': ' '.join(sys.argv), 'python': platform.python_version(),
+                              'platform': platform.platform(), 'peak_rss_mb': peak_rss_mb()}}
+
+
+def enable():
+    global _profile
+    _profile = Profile()
+    return _profile
+
+
+@contextmanager
+def stage(name, **counts):
+    # Records the stage around the block. Counts are given as arguments or set
+    # on the yielded dict by the block.
+    if _profile is None:
+        yield counts
+        return
+    start = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        _profile.add(name, start, counts)
+
+
+def add(name, start, **counts):
+    # Records a stage that started at `start` (a time.perf_counter()) and ends now
+    if _profile is not None:
+        _profile.add(name, start, counts)
+
+
+def _iterate(name, iterable, counts):
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        _profile.add(name, start, counts)
+        yield item
+
+
+def iterate(name, iterable, **counts):
+    # Records every step of a lazy iterable as a run of the stage
+    if _profile is None:
+        return iterable
+    return _iterate(name, iterable, counts)
+
+
+def report(trace_path=None):
+    if _profile is None:
+        return
+    # The summary goes to stderr so that it does not mix with results on stdout
+    print('\nProfile:\n' + _profile.table(), file=sys.stderr)
+    if trace_path:
+        with open(trace_path, 'w') as f:
+            json.dump(_profile.trace(), f)
+        print('Trace written to {}'.format(trace_path), file=sys.stderr)
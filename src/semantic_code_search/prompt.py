@@ -1,15 +1,20 @@
+import threading
 from dataclasses import dataclass
+from functools import lru_cache
 
 from prompt_toolkit import Application
 from prompt_toolkit.buffer import Buffer
+from prompt_toolkit.data_structures import Point
 from prompt_toolkit.document import Document
+from prompt_toolkit.filters import has_focus
 from prompt_toolkit.formatted_text import HTML, to_formatted_text
 from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.layout.containers import HSplit, VSplit, Window
-from prompt_toolkit.layout.controls import FormattedTextControl
+from prompt_toolkit.layout.containers import ConditionalContainer, HSplit, VSplit, Window
+from prompt_toolkit.layout.controls import BufferControl, FormattedTextControl
 from prompt_toolkit.layout.dimension import Dimension
 from prompt_toolkit.layout.layout import Layout
 from prompt_toolkit.lexers import PygmentsLexer
+from prompt_toolkit.patch_stdout import patch_stdout
 from prompt_toolkit.widgets.base import Frame
 from pygments.lexers.c_cpp import CLexer
 from pygments.lexers.c_cpp import CppLexer
@@ -28,13 +33,25 @@ class ResultEntry:
     file: str
     line: int
     text: str
+    repo: str = None
+
+    def label(self):
+        name = self.file.split("/")[-1:][0]
+        if self.repo:
+            name = '{}: {}'.format(self.repo.split("/")[-1:][0], name)
+        return '{}:{}'.format(name, self.line)
+
+
+# Only the beginning of longer snippets fits on screen, the rest is not highlighted
+_max_snippet_lines = 200
 
 
 def _format_input(results):
-    return [ResultEntry(score, entry.get('file'), entry.get('line'), entry.get('text')) for (score, entry) in results]
+    return [ResultEntry(score, entry.get('file'), entry.get('line'), entry.get('text'), entry.get('repo'))
+            for (score, entry) in results]
 
 
-def _syntax_highlighting(text, file):
+def _lexer_class(file):
     lexer = CLexer  # use c as default generic lexer
     if file.endswith('.py'):
         lexer = PythonLexer
@@ -58,21 +75,35 @@ def _syntax_highlighting(text, file):
         lexer = CLexer
     elif file.endswith('cpp') or file.endswith('hpp'):
         lexer = CppLexer
+    return lexer
 
-    pigment = PygmentsLexer(lexer, sync_from_start=True)
-    lex_func = pigment.lex_document(Document(text.replace('\t', '    ')))
-
-    lines = []
-    lines.append(to_formatted_text(HTML(file), style='#7474FF'))
-    lines.append([('', '\n\n')])
 
-    for i in range(0, len(text.split('\n'))):
-        lines.append(lex_func(i))
-        lines.append([('', '\n')])
-
-    return [item for sublist in lines for item in sublist]
+@lru_cache(maxsize=None)
+def _pygments_lexer(lexer):
+    # Instantiating a lexer compiles its regexes, so there is one per language
+    return PygmentsLexer(lexer, sync_from_start=True)
 
 
+def _syntax_highlighting(text, file):
+    lines = text.replace('\t', '    ').split('\n')
+    truncated = len(lines) > _max_snippet_lines
+    lines = lines[:_max_snippet_lines]
+    lex_func = _pygments_lexer(_lexer_class(file)).lex_document(Document('\n'.join(lines)))
+
+    fragments = to_formatted_text(HTML(file), style='#7474FF') + [('', '\n\n')]
+    for i in range(len(lines)):
+        fragments.extend(lex_func(i))
+        fragments.append(('', '\n'))
+    if truncated:
+        fragments.append(('', '...'))
+    return fragments
+
+
+# Results are searched in the background, so the screen opens right away and
+# shows results as they come in, e.g. shard by shard for a workspace. `search`
+# yields the results found so far for a query; pressing / edits the query and
+# searches it again with the same index and model. Snippets are only
+# highlighted when they are shown, and once per result.
 class ResultScreen():
 
     def _formatted_list(self):
@@ -80,90 +111,168 @@ class ResultScreen():
         for i, result in enumerate(self.results):
             if i == self.idx:
                 lines.append(to_formatted_text(HTML(
-                    f'👉 {result.score:.3f} {result.file.split("/")[-1:][0] }:{result.line}'), style='#7474FF'))
+                    f'👉 {result.score:.3f} {result.label()}'), style='#7474FF'))
             else:
                 lines.append(
-                    [('', f'   {result.score:.3f} {result.file.split("/")[-1:][0] }:{result.line}')])
+                    [('', f'   {result.score:.3f} {result.label()}')])
             lines.append([('', '\n')])
 
         return [item for sublist in lines for item in sublist]
 
+    def _snippet(self):
+        if not self.results:
+            return []
+        result = self.results[self.idx]
+        key = (result.repo, result.file, result.line)
+        if key not in self.snippets:
+            self.snippets[key] = _syntax_highlighting(result.text, result.file)
+        return self.snippets[key]
+
+    def _title(self):
+        return self.status.format(self.query)
+
+    def _list_width(self):
+        return min(40, max([len(f'   {r.score:.3f} {r.label()}') for r in self.results] + [17]) + 3)
+
+    def _snippet_height(self):
+        return Dimension(preferred=min(30, max([r.text.count('\n') + 4 for r in self.results] + [3])))
+
     def _go_down(self):
         if self.idx < len(self.results) - 1:
             self.idx += 1
-        self.snippet_content.text = self.results[self.idx].text
-        self.selection_content.text = self._formatted_list()
 
     def _go_up(self):
         if self.idx > 0:
             self.idx -= 1
-        self.snippet_content.text = self.results[self.idx].text
-        self.selection_content.text = self._formatted_list()
 
-    def __init__(self, results, query):
-        self.idx = 0
-        self.buffer = Buffer()
+    def _show(self, search_id, results, done):
+        if search_id != self.search_id:
+            return
         self.results = _format_input(results)
+        self.idx = min(self.idx, max(len(self.results) - 1, 0))
+        if done:
+            self.status = "Results for query '{}':" if self.results else "No results for query '{}'"
+        self.app.invalidate()
+
+    def _fail(self, search_id, error):
+        if search_id == self.search_id:
+            self.status = "Searching for '{}' failed: " + str(error).replace('{', '{{').replace('}', '}}')
+            self.app.invalidate()
+
+    def _run_search(self, search_id, query):
+        # Searches run one at a time, those that were superseded by another
+        # query stop at their next results
+        call = self.app.loop.call_soon_threadsafe
+        try:
+            with self.lock:
+                if search_id != self.search_id:
+                    return
+                results = []
+                for results in self.search(query):
+                    if search_id != self.search_id:
+                        return
+                    call(self._show, search_id, results, False)
+                call(self._show, search_id, results, True)
+        except (Exception, SystemExit) as e:
+            call(self._fail, search_id, e)
+
+    def _start_search(self, query):
+        self.query = query
+        self.search_id += 1
+        self.idx = 0
+        self.status = "Searching for '{}'..."
+        threading.Thread(target=self._run_search, args=(self.search_id, query), daemon=True).start()
 
-        for r in self.results:
-            r.text = _syntax_highlighting(r.text, r.file)
+    def _refine(self, buffer):
+        if buffer.text.strip():
+            self._start_search(buffer.text.strip())
+        self.app.layout.focus(self.selection_window)
+        return True
 
-        self.snippet_content = FormattedTextControl(
-            text=self.results[self.idx].text)
+    def __init__(self, search, query, results=None):
+        self.idx = 0
+        self.search = search
+        self.query = query
+        self.search_id = 0
+        self.snippets = {}
+        self.lock = threading.Lock()
+        self.results = _format_input(results or [])
+        self.status = "Results for query '{}':"
+        self.initial_results = results is not None
+        self.buffer = Buffer(multiline=False, accept_handler=self._refine)
+        editing = has_focus(self.buffer)
+
+        self.snippet_content = FormattedTextControl(text=self._snippet)
         self.selection_content = FormattedTextControl(
-            text=self._formatted_list())
+            text=self._formatted_list, focusable=True, show_cursor=False,
+            get_cursor_position=lambda: Point(x=0, y=self.idx * 2))
+        self.selection_window = Window(content=self.selection_content)
 
         self.root_container = HSplit([
-            Window(content=FormattedTextControl(
-                text="Results for query '{}':".format(query), show_cursor=True), height=1),
+            ConditionalContainer(Window(content=FormattedTextControl(text=self._title), height=1),
+                                 filter=~editing),
+            ConditionalContainer(Window(content=BufferControl(buffer=self.buffer), height=1,
+                                        get_line_prefix=lambda line, wrap_count: 'Query: '),
+                                 filter=editing),
             VSplit([
-                Frame(Window(content=self.selection_content),
-                      width=min(40, max([len(l[1]) for l in self._formatted_list()]) + 3)),
-                Frame(Window(content=self.snippet_content),
-                      height=Dimension(preferred=min(30, max([len(r.text) for r in self.results]))
-                                       )),
+                Frame(self.selection_window, width=self._list_width),
+                Frame(Window(content=self.snippet_content), height=self._snippet_height),
             ])])
-        self.layout = Layout(self.root_container)
+        self.layout = Layout(self.root_container, focused_element=self.selection_window)
         self.kb = KeyBindings()
 
         @self.kb.add('c-c')
         def _(event):
             event.app.exit()
 
-        @self.kb.add('q')
+        @self.kb.add('q', filter=~editing)
         def _(event):
             event.app.exit()
 
-        @self.kb.add('down')
+        @self.kb.add('down', filter=~editing)
         def _(event):
             self._go_down()
 
-        @self.kb.add('j')
+        @self.kb.add('j', filter=~editing)
         def _(event):
             self._go_down()
 
-        @self.kb.add('c-n')
+        @self.kb.add('c-n', filter=~editing)
         def _(event):
             self._go_down()
 
-        @self.kb.add('k')
+        @self.kb.add('k', filter=~editing)
         def _(event):
             self._go_up()
 
-        @self.kb.add('c-p')
+        @self.kb.add('c-p', filter=~editing)
         def _(event):
             self._go_up()
 
-        @self.kb.add('up')
+        @self.kb.add('up', filter=~editing)
         def _(event):
             self._go_up()
 
-        @self.kb.add('enter')
+        @self.kb.add('/', filter=~editing)
+        def _(event):
+            self.buffer.text = self.query
+            self.buffer.cursor_position = len(self.query)
+            event.app.layout.focus(self.buffer)
+
+        @self.kb.add('escape', filter=editing)
+        def _(event):
+            event.app.layout.focus(self.selection_window)
+
+        @self.kb.add('enter', filter=~editing)
         def _(event):
-            event.app.exit(result=self.idx)
+            if self.results:
+                event.app.exit(result=self.results[self.idx])
 
         self.app = Application(
             layout=self.layout, full_screen=False, erase_when_done=True, key_bindings=self.kb)
 
     def run(self):
-        return self.app.run()
+        # Output of the search, such as the progress of loading the model, is
+        # printed above the screen
+        with patch_stdout():
+            return self.app.run(pre_run=None if self.initial_results else lambda: self._start_search(self.query))
@@ -0,0 +1,90 @@
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# Compact copies of the normalized corpus embeddings that a query scans first,
+# before the best candidates are rescored against the stored vectors.
+#   int8:   every dimension is mapped linearly onto 256 levels between its
+#           minimum and maximum over the corpus (1 byte per dimension)
+#   binary: one bit per dimension, set if the value is above the corpus mean of
+#           that dimension, compared by Hamming distance (1 bit per dimension)
+
+METHODS = ['int8', 'binary']
+
+_popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _blocks(embeddings, block_size=65536):
+    for start in range(0, len(embeddings), block_size):
+        yield start, np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+
+
+def bytes_per_vector(method, dim):
+    return dim if method == 'int8' else (dim + 7) // 8
+
+
+def quantize(embeddings, method, path):
+    dim = embeddings.shape[1]
+    if method == 'int8':
+        low = np.full(dim, np.inf, dtype=np.float32)
+        high = np.full(dim, -np.inf, dtype=np.float32)
+        for _, block in _blocks(embeddings):
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        scale = np.maximum(high - low, 1e-12) / 255
+        codes = open_memmap(path + '/quantized_codes.npy', mode='w+', dtype=np.int8, shape=(len(embeddings), dim))
+        for start, block in _blocks(embeddings):
+            codes[start:start + len(block)] = np.round((block - low) / scale) - 128
+        np.save(path + '/quantized_params.npy', scale)
+    elif method == 'binary':
+        threshold = np.zeros(dim, dtype=np.float64)
+        for _, block in _blocks(embeddings):
+            threshold += block.sum(axis=0)
+        threshold = (threshold / max(len(embeddings), 1)).astype(np.float32)
+        codes = open_memmap(path + '/quantized_codes.npy', mode='w+', dtype=np.uint8,
+                            shape=(len(embeddings), bytes_per_vector(method, dim)))
+        for start, block in _blocks(embeddings):
+            codes[start:start + len(block)] = np.packbits(block > threshold, axis=1)
+        np.save(path + '/quantized_params.npy', threshold)
+    else:
+        raise ValueError('unknown quantization {}'.format(method))
+    codes.flush()
+    del codes
+
+
+def load_quantized(path, method):
+    return {'method': method,
+            'codes': np.load(path + '/quantized_codes.npy', mmap_mode='r'),
+            'params': np.load(path + '/quantized_params.npy')}
+
+
+def quantized_scores(quantized, query_embedding, rows=None, block_size=65536):
+    # Higher is better. Scores are only comparable between rows of the same
+    # query, which is all the first pass needs.
+    codes = quantized['codes'] if rows is None else quantized['codes'][rows]
+    scores = np.empty(len(codes), dtype=np.float32)
+    if quantized['method'] == 'int8':
+        # The offset of every dimension adds the same constant to all rows
+        weights = query_embedding * quantized['params']
+        for start in range(0, len(codes), block_size):
+            scores[start:start + block_size] = codes[start:start + block_size].astype(np.float32) @ weights
+    else:
+        query_bits = np.packbits(query_embedding > quantized['params'])
+        for start in range(0, len(codes), block_size):
+            different = np.bitwise_xor(codes[start:start + block_size], query_bits)
+            if hasattr(np, 'bitwise_count'):
+                different = np.bitwise_count(different)
+            else:
+                different = _popcount[different]
+            scores[start:start + block_size] = -different.sum(axis=1, dtype=np.int32)
+    return scores
+
+
+def quantized_candidates(quantized, query_embedding, candidates, n):
+    # The n best rows according to the quantized vectors, out of `candidates`
+    # or all rows
+    scores = quantized_scores(quantized, query_embedding, candidates)
+    n = min(n, len(scores))
+    if n == 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, n - 1)[:n]
+    return np.sort(top if candidates is None else candidates[top])
@@ -1,35 +1,234 @@
-import gzip
+import argparse
+import json
 import os
-import pickle
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import torch
-from sentence_transformers import util
+import numpy as np
 
-from semantic_code_search.embed import do_embed
-from semantic_code_search.prompt import ResultScreen
+from semantic_code_search import profiling
+from semantic_code_search.ann import ivf_candidates
+from semantic_code_search.index import load_index
+from semantic_code_search.quantize import quantized_candidates
+from semantic_code_search.encoders import encoder_name
+from semantic_code_search.query_cache import encode_queries
+from semantic_code_search.workspace import load_workspace_indexes, merge_results
 
 
-def _search(query_embedding, corpus_embeddings, functions, k=5, file_extension=None):
-    # TODO: filtering by file extension
-    cos_scores = util.cos_sim(query_embedding, corpus_embeddings)[0]
-    top_results = torch.topk(cos_scores, k=min(k, len(cos_scores)), sorted=True)
-    out = []
-    for score, idx in zip(top_results[0], top_results[1]):
-        out.append((score, functions[idx]))
-    return out
+# Filtered candidate sets up to this size are scored exhaustively even when
+# there is an approximate nearest neighbor index
+_exact_subset_size = 50000
 
 
-def _query_embeddings(model, args):
-    with gzip.open(args.path_to_repo + '/' + '.embeddings', 'r') as f:
-        dataset = pickle.loads(f.read())
-        if dataset.get('model_name') != args.model_name_or_path:
-            print('Model name mismatch. Regenerating embeddings.')
-            dataset = do_embed(args, model)
-        query_embedding = model.encode(args.query_text, convert_to_tensor=True)
-        results = _search(query_embedding, dataset.get(
-            'embeddings'), dataset.get('functions'), k=args.n_results, file_extension=args.file_extension)
-        return results
+# Batch queries are scored in groups so that the score matrix stays below this
+# many entries
+_batch_scores_size = 1 << 26
+
+
+def _scores(corpus_embeddings, query_embedding, block_size=65536):
+    # query_embedding is either a single vector or a (dim, n_queries) matrix
+    if corpus_embeddings.dtype == np.float32:
+        return corpus_embeddings @ query_embedding
+    # Upcast reduced precision vectors block by block rather than materializing
+    # a float32 copy of the whole matrix
+    scores = np.empty((len(corpus_embeddings),) + query_embedding.shape[1:], dtype=np.float32)
+    for start in range(0, len(corpus_embeddings), block_size):
+        scores[start:start + block_size] = corpus_embeddings[start:start +
+                                                             block_size].astype(np.float32) @ query_embedding
+    return scores
+
+
+def _top_k(scores, k):
+    k = min(k, len(scores))
+    if k == 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def _top_units(scores, k, index, rows=None):
+    # The k best scoring rows of distinct units. The windows of a long unit are
+    # max-pooled, the unit is represented by its best scoring window.
+    if not index.meta.get('chunked'):
+        return _top_k(scores, k)
+    n = k
+    while True:
+        top = _top_k(scores, n)
+        _, first = np.unique(index.unit_rows(top if rows is None else rows[top]), return_index=True)
+        if len(first) >= k or n >= len(scores):
+            return top[np.sort(first)[:k]]
+        n = min(len(scores), n * 4)
+
+
+def _search(query_embedding, index, k=5, file_extension=None, language=None, path_glob=None, n_probe=None,
+            rescore=None):
+    query_embedding = np.asarray(query_embedding, dtype=np.float32)
+    query_embedding = query_embedding / np.linalg.norm(query_embedding)
+    # Filters select the candidate rows before scoring, so that filtered queries
+    # score fewer vectors instead of oversampling and discarding results
+    selected = index.select(file_extension, language, path_glob)
+    candidates = selected
+    if n_probe and index.ivf is not None and (selected is None or len(selected) > _exact_subset_size):
+        candidates = ivf_candidates(index.ivf, query_embedding, n_probe)
+        if selected is not None:
+            candidates = np.intersect1d(candidates, selected, assume_unique=True)
+            if len(candidates) < k:
+                # The probed partitions hold too few matches, fall back to exact
+                candidates = selected
+    if rescore and index.quantized is not None and (candidates is None or len(candidates) > k * rescore):
+        # Shortlist with the quantized vectors, then rescore the shortlist exactly
+        candidates = quantized_candidates(index.quantized, query_embedding, candidates, k * rescore)
+    if candidates is None:
+        scores = _scores(index.embeddings, query_embedding)
+        return [(float(scores[idx]), index.function(idx)) for idx in _top_units(scores, k, index)]
+    scores = _scores(index.embeddings[candidates], query_embedding)
+    return [(float(scores[i]), index.function(candidates[i])) for i in _top_units(scores, k, index, candidates)]
+
+
+def _search_batch(query_embeddings, index, k=5, file_extension=None, language=None, path_glob=None, n_probe=None,
+                  rescore=None):
+    # Yields the results of every query in order. Without an approximate index
+    # all queries are scored against the corpus in a single matrix product.
+    query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+    selected = index.select(file_extension, language, path_glob)
+    if (n_probe and index.ivf is not None and (selected is None or len(selected) > _exact_subset_size)) or \
+            (rescore and index.quantized is not None):
+        # Every query probes different partitions or rescores a different shortlist
+        for query_embedding in query_embeddings:
+            yield _search(query_embedding, index, k, file_extension, language, path_glob, n_probe, rescore)
+        return
+    query_embeddings = query_embeddings / np.linalg.norm(query_embeddings, axis=1, keepdims=True)
+    corpus = index.embeddings if selected is None else index.embeddings[selected]
+    group_size = max(1, _batch_scores_size // max(len(corpus), 1))
+    for start in range(0, len(query_embeddings), group_size):
+        scores = _scores(corpus, query_embeddings[start:start + group_size].T)
+        for j in range(scores.shape[1]):
+            top = _top_units(scores[:, j], k, index, selected)
+            rows = top if selected is None else selected[top]
+            yield [(float(scores[i, j]), index.function(idx)) for i, idx in zip(top, rows)]
+
+
+def _query_cache_bytes(args):
+    return int(getattr(args, 'query_cache_size', 0) * 1024 * 1024)
+
+
+def _search_shards(search, indexes, jobs):
+    # The shards of a workspace are searched in threads, which run in parallel
+    # because numpy releases the GIL while scoring
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(indexes)))) as executor:
+        return list(executor.map(search, indexes))
+
+
+def _query_indexes(model, args, index=None):
+    if index is None and getattr(args, 'workspace', None):
+        with profiling.stage('load index') as counts:
+            indexes = load_workspace_indexes(args, model)
+            counts.update(shards=len(indexes), functions=sum(len(index) for index in indexes))
+        return indexes
+    if index is None:
+        with profiling.stage('load index') as counts:
+            index = load_index(args.path_to_repo)
+            counts['functions'] = len(index) if index is not None else 0
+    if index is None or index.model_name != args.model_name_or_path:
+        print('Embeddings not found or outdated in {}. Generating embeddings now.'.format(args.path_to_repo))
+        from semantic_code_search.embed import do_embed
+        index = do_embed(args, model)
+    return [index]
+
+
+def _iter_query_results(model, args, indexes):
+    # Yields the results found so far: once for a repo, and for a workspace
+    # every time another shard is done
+    with profiling.stage('encode query', queries=1):
+        query_embedding = encode_queries(model, encoder_name(args), [args.query_text],
+                                         max_bytes=_query_cache_bytes(args))[0]
+
+    def search(index):
+        with profiling.stage('search', functions=len(index)):
+            return _search(query_embedding, index, k=args.n_results, file_extension=args.file_extension,
+                           language=args.language, path_glob=args.path_glob,
+                           n_probe=None if args.exact else args.ann_probe,
+                           rescore=None if args.exact else args.rescore)
+    if not getattr(args, 'workspace', None):
+        yield search(indexes[0])
+        return
+    shard_results = [[] for _ in indexes]
+    with ThreadPoolExecutor(max_workers=max(1, min(args.jobs, len(indexes)))) as executor:
+        futures = {executor.submit(search, index): i for i, index in enumerate(indexes)}
+        for future in as_completed(futures):
+            shard_results[futures[future]] = future.result()
+            yield merge_results(indexes, shard_results, args.n_results)
+
+
+def _query_embeddings(model, args, index=None):
+    results = []
+    for results in _iter_query_results(model, args, _query_indexes(model, args, index)):
+        pass
+    return results
+
+
+def _read_queries(path):
+    f = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        return [line.strip() for line in f if line.strip()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _result_record(score, entry, root):
+    # Results of a workspace are tagged with their repo and relative to it
+    record = {'score': score, 'file': os.path.relpath(entry['file'], entry.get('repo', root)),
+              'line': entry['line'] + 1, 'kind': entry['kind'], 'snippet': entry['text']}
+    if 'repo' in entry:
+        record['repo'] = entry['repo']
+    return record
+
+
+def do_batch_query(args, model):
+    queries = _read_queries(args.batch)
+    if not queries:
+        sys.stdout.write('[]\n' if args.format == 'json' else '')
+        return
+    # Progress goes to stderr to keep stdout parseable
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        indexes = _query_indexes(model, args)
+    finally:
+        sys.stdout = stdout
+
+    with profiling.stage('encode query', queries=len(queries)):
+        query_embeddings = encode_queries(model, encoder_name(args), queries, args.batch_size,
+                                          _query_cache_bytes(args))
+
+    def search(index):
+        return _search_batch(query_embeddings, index, k=args.n_results, file_extension=args.file_extension,
+                             language=args.language, path_glob=args.path_glob,
+                             n_probe=None if args.exact else args.ann_probe,
+                             rescore=None if args.exact else args.rescore)
+
+    def search_all(index):
+        with profiling.stage('search', queries=len(queries), functions=len(index)):
+            return list(search(index))
+    if args.workspace:
+        shard_results = _search_shards(search_all, indexes, args.jobs)
+        results = (merge_results(indexes, [r[i] for r in shard_results], args.n_results) for i in range(len(queries)))
+    else:
+        results = profiling.iterate('search', search(indexes[0]), queries=1, functions=len(indexes[0]))
+    # Results are written as soon as each query is done. The json format
+    # streams the elements of a single array.
+    if args.format == 'json':
+        sys.stdout.write('[')
+    for i, (query, query_results) in enumerate(zip(queries, results)):
+        record = {'query': query,
+                  'results': [_result_record(score, entry, args.path_to_repo) for score, entry in query_results]}
+        if args.format == 'json':
+            sys.stdout.write((',\n' if i else '\n') + json.dumps(record))
+        else:
+            sys.stdout.write(json.dumps(record) + '\n')
+        sys.stdout.flush()
+    if args.format == 'json':
+        sys.stdout.write('\n]\n')
 
 
 def open_in_editor(file, line, editor):
@@ -39,25 +238,33 @@ def open_in_editor(file, line, editor):
         os.system('code --goto {}:{}'.format(file, line))
 
 
-def do_query(args, model):
+def do_query(args, model, results=None):
     if not args.query_text:
         print('provide a query')
         # todo: add a prompt here as a fallback
         sys.exit(1)
 
-    if not os.path.isfile(args.path_to_repo + '/' + '.embeddings'):
-        print('Embeddings not found in {}. Generating embeddings now.'.format(
-            args.path_to_repo))
-        do_embed(args, model)
+    # Results given by a server are shown as they are, and refined queries are
+    # sent to the server too. Otherwise the index is loaded, or generated, before
+    # the result screen opens, and queries are searched in the background while
+    # it is shown.
+    indexes = [] if results is not None else _query_indexes(model, args)
 
-    results = _query_embeddings(model, args)
+    def search(query_text):
+        query_args = argparse.Namespace(**vars(args))
+        query_args.query_text = query_text
+        if not indexes:
+            from semantic_code_search.server import query_server
+            server_results = query_server(query_args)
+            if server_results is not None:
+                yield server_results
+                return
+            indexes.extend(_query_indexes(model, query_args))
+        yield from _iter_query_results(model, query_args, indexes)
 
-    selected_idx = ResultScreen(results, args.query_text).run()
-    if not selected_idx:
+    from semantic_code_search.prompt import ResultScreen
+    selected = ResultScreen(search, args.query_text, results).run()
+    if selected is None:
         sys.exit(0)  # user cancelled
-    file_path_with_line = (
-        results[selected_idx][1]['file'], results[selected_idx][1]['line'] + 1)
-    if file_path_with_line is not None:
-        open_in_editor(
-            file_path_with_line[0], file_path_with_line[1], args.editor)
-        sys.exit(0)
+    open_in_editor(selected.file, selected.line + 1, args.editor)
+    sys.exit(0)
@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+# Query vectors are cached on disk, keyed by model and query text, so that
+# repeated queries skip the model entirely. The least recently used entries are
+# evicted once the vectors exceed the size limit.
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'semantic-code-search')
+
+
+def cache_path():
+    return os.path.join(cache_dir(), 'queries.sqlite')
+
+
+def normalize_query(text):
+    return ' '.join(text.split())
+
+
+class QueryCache():
+
+    def __init__(self, path, max_bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, timeout=5)
+        self.db.execute('CREATE TABLE IF NOT EXISTS queries '
+                        '(model TEXT, query TEXT, vector BLOB, used REAL, PRIMARY KEY (model, query))')
+
+    def get(self, model, queries):
+        found = {}
+        for query in set(queries):
+            row = self.db.execute('SELECT vector FROM queries WHERE model = ? AND query = ?',
+                                  (model, query)).fetchone()
+            if row is not None:
+                found[query] = np.frombuffer(row[0], dtype=np.float32)
+        with self.db:
+            self.db.executemany('UPDATE queries SET used = ? WHERE model = ? AND query = ?',
+                                [(time.time(), model, query) for query in found])
+        return found
+
+    def put(self, model, vectors):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)',
+                                [(model, query, np.asarray(vector, dtype=np.float32).tobytes(), time.time())
+                                 for query, vector in vectors.items()])
+            total = 0
+            evict = []
+            for rowid, size in self.db.execute('SELECT rowid, length(vector) FROM queries ORDER BY used DESC'):
+                total += size
+                if total > self.max_bytes:
+                    evict.append((rowid,))
+            self.db.executemany('DELETE FROM queries WHERE rowid = ?', evict)
+
+    def close(self):
+        self.db.close()
+
+
+def encode_queries(model, model_name, queries, batch_size=32, max_bytes=0):
+    # Returns one vector per query, only encoding the queries that are not cached.
+    # The model is not touched at all if every query is cached.
+    queries = [normalize_query(q) for q in queries]
+    if not max_bytes:
+        return np.asarray(model.encode(queries, batch_size=batch_size, convert_to_numpy=True), dtype=np.float32)
+    cache = None
+    vectors = {}
+    try:
+        cache = QueryCache(cache_path(), max_bytes)
+        vectors = cache.get(model_name, queries)
+    except (sqlite3.Error, OSError):
+        # A broken or locked cache only costs the encoding
+        cache = None
+    missing = list(dict.fromkeys(q for q in queries if q not in vectors))
+    if missing:
+        encoded = model.encode(missing, batch_size=batch_size, convert_to_numpy=True)
+        new = dict(zip(missing, np.asarray(encoded, dtype=np.float32)))
+        vectors.update(new)
+        if cache is not None:
+            try:
+                cache.put(model_name, new)
+            except sqlite3.Error:
+                pass
+    if cache is not None:
+        cache.close()
+    return np.stack([vectors[q] for q in queries])
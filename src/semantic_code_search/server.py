@@ -0,0 +1,117 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+
+from semantic_code_search import profiling
+
+# The client side (`query_server`) only uses the standard library, so that a
+# query answered by a server does not import numpy, the model or tree-sitter.
+
+# Arguments that affect the results of a query and are therefore forwarded
+# from the client to the server with every request.
+_forwarded_args = ['query_text', 'n_results', 'file_extension', 'language', 'path_glob', 'exact', 'ann_probe', 'rescore']
+
+
+def socket_path(root):
+    # Unix socket paths are limited to ~100 characters, so the socket lives in
+    # the temp directory under a name derived from the repo root.
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    digest = hashlib.sha1(root.encode('utf8')).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), 'sem-{}-{}.sock'.format(uid, digest))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = {'results': self.server.search(request)}
+        except Exception as e:
+            response = {'error': str(e)}
+        self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, args, model, index):
+        super().__init__(path, _Handler)
+        self.args = args
+        self.model = model
+        self.index = index
+        self.lock = threading.Lock()
+
+    def search(self, request):
+        from semantic_code_search.index import load_index
+        from semantic_code_search.query import _query_embeddings
+
+        if request.get('model_name_or_path') != self.args.model_name_or_path:
+            raise ValueError('server uses model {}'.format(self.args.model_name_or_path))
+        with self.lock:
+            # Pick up indexes that were regenerated since the server started
+            current = load_index(self.args.path_to_repo)
+            if current is not None and current.path != self.index.path and current.model_name == self.index.model_name:
+                self.index = current
+            query_args = argparse.Namespace(**vars(self.args))
+            for name in _forwarded_args:
+                setattr(query_args, name, request.get(name))
+            results = _query_embeddings(self.model, query_args, self.index)
+        return [[score, entry] for score, entry in results]
+
+
+def query_server(args, timeout=60):
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path(args.path_to_repo)):
+        return None
+    request = {name: getattr(args, name) for name in _forwarded_args}
+    request['model_name_or_path'] = args.model_name_or_path
+    try:
+        with profiling.stage('server query'), socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(socket_path(args.path_to_repo))
+            s.sendall(json.dumps(request).encode('utf8') + b'\n')
+            response = json.loads(s.makefile('rb').readline())
+    except (OSError, ValueError):
+        return None
+    if 'error' in response:
+        return None
+    return [(score, entry) for score, entry in response.get('results')]
+
+
+def do_serve(args, model):
+    if not hasattr(socket, 'AF_UNIX'):
+        print('Serving is not supported on this platform')
+        return
+    from semantic_code_search.embed import do_embed
+    from semantic_code_search.index import load_index
+
+    index = load_index(args.path_to_repo)
+    if index is None or index.model_name != args.model_name_or_path:
+        print('Embeddings not found or outdated in {}. Generating embeddings now.'.format(
+            args.path_to_repo))
+        index = do_embed(args, model)
+
+    path = socket_path(args.path_to_repo)
+    if os.path.exists(path):
+        # A socket nobody is listening on is left over from a server that died
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(path)
+            print('A server for {} is already running'.format(args.path_to_repo))
+            return
+        except OSError:
+            os.remove(path)
+
+    server = _Server(path, args, model, index)
+    print('Serving queries for {} on {}'.format(args.path_to_repo, path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
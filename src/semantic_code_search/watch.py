@@ -0,0 +1,110 @@
+import argparse
+import os
+import threading
+import time
+
+from semantic_code_search.embed import _get_repo_files, do_embed
+from semantic_code_search.index import load_index
+
+# Keeps the index of a repo up to date with its working tree. Changes are
+# picked up from filesystem events (inotify, FSEvents, ... through watchdog) if
+# watchdog is installed, or by polling git otherwise. Once the tree has been
+# quiet for the debounce interval, the index is rebuilt incrementally: only
+# changed files are parsed and only changed functions are encoded. Every update
+# is a new index generation that replaces the current one atomically, so
+# queries always see a complete index.
+
+
+class _Changes():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.last = 0
+
+    def touch(self):
+        with self.lock:
+            self.last = time.monotonic()
+        self.event.set()
+
+    def wait(self, debounce):
+        self.event.wait()
+        while True:
+            with self.lock:
+                quiet = time.monotonic() - self.last
+            if quiet >= debounce:
+                break
+            time.sleep(debounce - quiet)
+        # Changes from here on trigger another update
+        self.event.clear()
+
+
+def _ignored(root, path):
+    return os.path.relpath(path, root).split(os.sep)[0] in ('.git', '.embeddings')
+
+
+def _start_observer(root, changes):
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+
+    class Handler(FileSystemEventHandler):
+
+        def on_any_event(self, event):
+            paths = [event.src_path, getattr(event, 'dest_path', None)]
+            if any(p and not _ignored(root, p) for p in paths):
+                changes.touch()
+
+    observer = Observer()
+    observer.schedule(Handler(), root, recursive=True)
+    observer.start()
+    return observer
+
+
+def _poll(root, changes, interval, stop):
+    files = _get_repo_files(root)
+    while not stop.wait(interval):
+        current = _get_repo_files(root)
+        if current != files:
+            files = current
+            changes.touch()
+
+
+def _update(args, model):
+    # Events for ignored files or edits that were reverted change nothing
+    index = load_index(args.path_to_repo)
+    if index is not None and index.model_name == args.model_name_or_path and \
+            index.files == _get_repo_files(args.path_to_repo):
+        return
+    do_embed(args, model)
+    print('Index of {} updated at {}'.format(args.path_to_repo, time.strftime('%H:%M:%S')))
+
+
+def do_watch(args, model):
+    args = argparse.Namespace(**vars(args))
+    args.incremental = True
+    # Updates wait for a `sem --embed` that is running, then build on its index
+    args.wait_for_lock = True
+    changes = _Changes()
+    stop = threading.Event()
+    observer = _start_observer(args.path_to_repo, changes)
+    if observer is None:
+        print('watchdog is not installed, polling for changes every {}s'.format(args.watch_interval))
+        threading.Thread(target=_poll, args=(args.path_to_repo, changes, args.watch_interval, stop),
+                         daemon=True).start()
+
+    try:
+        _update(args, model)
+        print('Watching {} for changes'.format(args.path_to_repo))
+        while True:
+            changes.wait(args.watch_debounce)
+            _update(args, model)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        if observer is not None:
+            observer.stop()
+            observer.join()
@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import sys
+
+from semantic_code_search.index import load_index
+
+# A workspace is a JSON file listing the roots of several repos. Every repo
+# keeps its own index in <repo>/.embeddings, which is a shard of the workspace:
+# shards are built and incrementally rebuilt independently, and queries search
+# all of them and merge the results.
+
+
+def load_workspace(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f).get('repos', [])
+    except FileNotFoundError:
+        return []
+
+
+def update_workspace(path, add=None, remove=None):
+    repos = load_workspace(path)
+    repos.extend(root for root in add or [] if root not in repos)
+    repos = [root for root in repos if root not in (remove or [])]
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'repos': repos}, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return repos
+
+
+def _repo_args(args, root):
+    repo_args = argparse.Namespace(**vars(args))
+    repo_args.path_to_repo = root
+    return repo_args
+
+
+def _workspace_repos(args):
+    repos = load_workspace(args.workspace)
+    if not repos:
+        print('No repos in workspace {}. Add some with --add-repo PATH'.format(args.workspace))
+        sys.exit(1)
+    return repos
+
+
+def load_workspace_indexes(args, model):
+    # The indexes of all repos of the workspace, generating the missing or
+    # outdated ones
+    indexes = []
+    for root in _workspace_repos(args):
+        index = load_index(root)
+        if index is None or index.model_name != args.model_name_or_path:
+            print('Embeddings not found or outdated in {}. Generating embeddings now.'.format(root))
+            from semantic_code_search.embed import do_embed
+            index = do_embed(_repo_args(args, root), model)
+        indexes.append(index)
+    return indexes
+
+
+def merge_results(indexes, shard_results, k):
+    # Merges the top k of every shard into the top k of the workspace, tagging
+    # every result with the root of its repo
+    merged = []
+    for index, results in zip(indexes, shard_results):
+        for score, entry in results:
+            entry['repo'] = index.root
+            merged.append((score, entry))
+    merged.sort(key=lambda result: -result[0])
+    return merged[:k]
+
+
+def do_workspace_embed(args, model):
+    from semantic_code_search.embed import do_embed
+    for root in _workspace_repos(args):
+        print('Embedding {}'.format(root))
+        do_embed(_repo_args(args, root), model)